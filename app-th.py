@@ -1,10 +1,13 @@
 import gradio as gr
 import argparse
-from inference.tts_with_voiceclone import generate_speech, save_audio, get_model_names, voice_cloning
+from inference.tts_with_voiceclone import generate_speech, generate_speech_stream, save_audio, get_model_names, voice_cloning
 from inference.openvoice import voice_cloning as vc_voice_cloning
 from inference.dubbing import dub_srt, get_model_names as get_dubbing_model_names
 from inference.podcast import generate_podcast_script, get_model_names as get_podcast_model_names
 from inference.thaicleantext import clean_thai_text
+from inference.workspace import JobWorkspace, read_result
+from inference.model_registry import preload_models
+from inference.model_fetcher import start_fetch, fetch_progress
 import os
 
 model_dir = "./models"
@@ -23,10 +26,13 @@ def create_tts_interface():
             with gr.Column():
                 model = gr.Dropdown(model_names, label="โมเดล", interactive=True)
                 speaking_rate = gr.Slider(minimum=0.1, maximum=2.0, value=1.0, step=0.1, label="ความเร็วในการพูด")
+                seed = gr.Number(value=-1, precision=0, label="Seed (-1 = สุ่ม)")
 
             with gr.Column():
                 model_name_input = gr.Textbox(label="ดาวน์โหลด โมเดล", placeholder="e.g., VIZINTZOR/MMS-TTS-THAI-MALEV1")
                 download_btn = gr.Button("ดาวน์โหลด")
+                refresh_btn = gr.Button("รีเฟรช", size="sm")
+                download_progress = gr.Textbox(label="สถานะการดาวน์โหลด", value=fetch_progress, every=1, interactive=False)
 
             with gr.Column():
                 clone_checkbox = gr.Checkbox(label="โคลนเสียง", value=False)
@@ -36,23 +42,37 @@ def create_tts_interface():
                 vad = gr.Checkbox(label="VAD", value=True,info="สามารถใช้ได้กับเสียงและข้อความที่มีความยาว 5 วินาทีขึ้นไป")
         
         generate_btn = gr.Button("สร้าง")
+        stream_btn = gr.Button("สตรีม")
+        stream_audio = gr.Audio(label="เสียงแบบสตรีม", streaming=True, autoplay=True)
         output_audio = gr.Audio(label="เสียง")
         status = gr.Textbox(label="สถานะ")
         
         def download_model(model_name):
-            os.system(f"git clone https://huggingface.co/{model_name} {model_dir}/{model_name.split('/')[-1]}")
-            return f"Model {model_name} ดาวน์โหลด โมเดลเสียงแล้ว!", gr.update(choices=get_model_names(model_dir))
+            # The fetch runs in the background; progress shows in the downloads box and the
+            # model appears in the list once all of its files are verified
+            start_fetch(model_name, model_dir)
+            return f"กำลังดาวน์โหลด {model_name}...", gr.update(choices=get_model_names(model_dir))
         
-        def ui_fn(text, model_name, speaking_rate, clone, reference_speaker, model_version, device_choice, vad_select):
+        def ui_fn(text, model_name, speaking_rate, seed, clone, reference_speaker, model_version, device_choice, vad_select):
             cleaned_text = clean_thai_text(text)
-            sampling_rate, audio_data = generate_speech(cleaned_text, model_dir, model_name, speaking_rate)
-            audio_file = save_audio(sampling_rate, audio_data)
+            # A fixed seed makes the result reproducible and lets repeated clicks reuse the cached waveform
+            seed = int(seed) if seed is not None and seed >= 0 else None
+            sampling_rate, audio_data = generate_speech(cleaned_text, model_dir, model_name, speaking_rate, seed=seed)
             
             if clone:
-                cloned_audio_file, status = voice_cloning(audio_file, reference_speaker, model_version, device_choice, vad_select)
-                return cloned_audio_file, status
+                # Intermediate files live in a per-request workspace; the result is returned in memory
+                with JobWorkspace('tts') as workspace:
+                    audio_file = save_audio(sampling_rate, audio_data, workspace.file("output_tts.wav"))
+                    cloned_audio_file, status = voice_cloning(audio_file, reference_speaker, model_version, device_choice, vad_select, workspace)
+                    return (read_result(cloned_audio_file) if cloned_audio_file else None), status
             else:
-                return audio_file, "สร้างคำพูดสำเร็จ!"
+                return (sampling_rate, audio_data), "สร้างคำพูดสำเร็จ!"
+        
+        def stream_fn(text, model_name, speaking_rate):
+            cleaned_text = clean_thai_text(text)
+            timings = {}
+            for sampling_rate, chunk in generate_speech_stream(cleaned_text, model_dir, model_name, speaking_rate, timings=timings):
+                yield (sampling_rate, chunk), f"เวลาจนถึงเสียงแรก: {timings['time_to_first_audio']:.2f}s"
         
         download_btn.click(
             download_model,
@@ -60,11 +80,22 @@ def create_tts_interface():
             outputs=[status, model]
         )
         
+        refresh_btn.click(
+            lambda: gr.update(choices=get_model_names(model_dir)),
+            outputs=[model]
+        )
+        
         generate_btn.click(
             ui_fn,
-            inputs=[text_input, model, speaking_rate, clone_checkbox, ref_audio, model_version, device, vad],
+            inputs=[text_input, model, speaking_rate, seed, clone_checkbox, ref_audio, model_version, device, vad],
             outputs=[output_audio, status]
         )
+        
+        stream_btn.click(
+            stream_fn,
+            inputs=[text_input, model, speaking_rate],
+            outputs=[stream_audio, status]
+        )
 
 def create_vc_interface():
     with gr.Column():
@@ -85,8 +116,9 @@ def create_vc_interface():
         status = gr.Textbox(label="สถานะ")
         
         def handle_clone(base_speaker, reference_speaker, model_version, device_choice, vad_select):
-            result, status = vc_voice_cloning(base_speaker, reference_speaker, model_version, device_choice, vad_select)
-            return result, status
+            with JobWorkspace('clone') as workspace:
+                result, status = vc_voice_cloning(base_speaker, reference_speaker, model_version, device_choice, vad_select, workspace)
+                return (read_result(result) if result else None), status
         
         clone_btn.click(
             handle_clone,
@@ -128,6 +160,8 @@ def create_dubbing_interface():
             clone_checkbox = gr.Checkbox(label="โคลนเสียง", value=False)
             original_value = gr.Slider(0.0, 1.0, 0.5, step=0.1, value=0.5,label="ความดังเสียงต้นฉบับ", interactive=True)
             dubbing_value = gr.Slider(0.0, 1.0, 1.0, step=0.1, value=2,label="ความดังเสียงพากย์", interactive=True)
+            num_workers = gr.Slider(1, os.cpu_count() or 1, 1, step=1, value=1, label="จำนวน Worker", interactive=True)
+            fit_to_slot = gr.Checkbox(label="ปรับความเร็วให้พอดีซับไตเติล", value=False)
             refresh_btn = gr.Button("รีเฟรช", size="sm")
 
         def refresh():
@@ -144,7 +178,7 @@ def create_dubbing_interface():
         output_file = gr.File(label="ผลลัพธ์")
         status = gr.Textbox(label="สถานะ")
         
-        def ui_fn(srt_file, media_file, num_speakers, model_version, device_choice, vad_select, output_type, clone, original_value, dubbing_value, *args):
+        def ui_fn(srt_file, media_file, num_speakers, model_version, device_choice, vad_select, output_type, clone, original_value, dubbing_value, num_workers, fit_to_slot, *args):
             mid = len(args) // 2
             reference_speakers = args[:mid]
             models = args[mid:]
@@ -167,7 +201,9 @@ def create_dubbing_interface():
                 output_type,
                 original_value,  # Original volume
                 dubbing_value,  # Dubbing volume
-                clone
+                clone,
+                num_workers=int(num_workers),
+                fit_to_slot=fit_to_slot
             )
             return output_file, status
         
@@ -178,7 +214,7 @@ def create_dubbing_interface():
 
         dub_btn.click(
             ui_fn,
-            inputs=[srt_file, media_file, num_speakers, model_version, device, vad, output_type, clone_checkbox, original_value, dubbing_value, *reference_speakers, *model_inputs],
+            inputs=[srt_file, media_file, num_speakers, model_version, device, vad, output_type, clone_checkbox, original_value, dubbing_value, num_workers, fit_to_slot, *reference_speakers, *model_inputs],
             outputs=[output_file, status]
         )
 
@@ -196,6 +232,8 @@ def create_podcast_interface():
                 model1 = gr.Dropdown(model_names, label="โมเดล 1")
                 model2 = gr.Dropdown(model_names, label="โมเดล 2")
                 speaking_rate = gr.Slider(minimum=0.1, maximum=2.0, value=1.0, step=0.1, label="ความเร็วในการพูด")
+                gap_seconds = gr.Slider(minimum=0.0, maximum=2.0, value=0.0, step=0.1, label="ช่วงเว้นระหว่างประโยค (วินาที)")
+                crossfade_ms = gr.Slider(minimum=0, maximum=200, value=0, step=10, label="ครอสเฟด (มิลลิวินาที)")
                 refresh_btn = gr.Button("รีเฟรช", size="md")
                 
         def refresh():
@@ -206,11 +244,13 @@ def create_podcast_interface():
         output_audio = gr.Audio(label="เสียงพอดแคสต์")
         status = gr.Textbox(label="สถานะ")
         
-        def ui_fn(script, model1, model2, speaking_rate):
+        def ui_fn(script, model1, model2, speaking_rate, gap_seconds, crossfade_ms):
             cleaned_script = clean_thai_text(script)
             model_names = [model1, model2]
-            output_file, status = generate_podcast_script(cleaned_script, model_dir, model_names, speaking_rate)
-            return output_file, status
+            with JobWorkspace('podcast') as workspace:
+                output_file, status = generate_podcast_script(cleaned_script, model_dir, model_names, speaking_rate, workspace=workspace,
+                                                              gap_seconds=gap_seconds, crossfade_ms=crossfade_ms)
+                return (read_result(output_file) if output_file else None), status
         
         refresh_btn.click(
             refresh,
@@ -219,7 +259,7 @@ def create_podcast_interface():
 
         generate_btn.click(
             ui_fn,
-            inputs=[script_input, model1, model2, speaking_rate],
+            inputs=[script_input, model1, model2, speaking_rate, gap_seconds, crossfade_ms],
             outputs=[output_audio, status]
         )
 
@@ -242,8 +282,11 @@ def create_app():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--share", type=bool, default=False, help="Enable Gradio share mode")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of requests the Gradio queue runs in parallel")
+    parser.add_argument("--preload", nargs="*", default=[], help="Models from ./models to load before the UI starts")
     args = parser.parse_args()
     
+    preload_models(args.preload, model_dir)
     app = create_app()
-    app.queue()
+    app.queue(default_concurrency_limit=args.concurrency)
     app.launch(inbrowser=True, share=args.share)
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+import torch
+import numpy as np
+from scipy.signal import resample_poly
+from openvoice.api import ToneColorConverter
+
+# Process-wide ToneColorConverter registry keyed by (model_version, device, enable_watermark)
+converter_dir = './OPENVOICE_MODELS'
+max_converters = 4
+
+converters = OrderedDict()
+converters_lock = threading.Lock()
+
+def resolve_device(device_choice):
+    return "cuda:0" if device_choice == "GPU" and torch.cuda.is_available() else "cpu"
+
+def get_tone_color_converter(model_version, device_choice, enable_watermark=True):
+    device = resolve_device(device_choice)
+    key = (model_version, device, enable_watermark)
+
+    with converters_lock:
+        if key in converters:
+            converters.move_to_end(key)
+            return converters[key]
+
+        ckpt_converter = f'{converter_dir}/{model_version}'
+        tone_color_converter = ToneColorConverter(f'{ckpt_converter}/config.json', device=device, enable_watermark=enable_watermark)
+        tone_color_converter.load_ckpt(f'{ckpt_converter}/checkpoint.pth')
+        converters[key] = tone_color_converter
+
+        # Drop the least recently used converters beyond the limit
+        while len(converters) > max_converters:
+            converters.popitem(last=False)
+
+    return tone_color_converter
+
+def unload_converters(model_version=None, device_choice=None):
+    device = resolve_device(device_choice) if device_choice is not None else None
+    with converters_lock:
+        for key in list(converters):
+            if model_version is not None and key[0] != model_version:
+                continue
+            if device is not None and key[1] != device:
+                continue
+            del converters[key]
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def watermark_samples(tone_color_converter, sampling_rate, message="default"):
+    # Length at sampling_rate of the track prefix that carries the watermark
+    converter_sr = tone_color_converter.hps.data.sampling_rate
+    return int(np.ceil(tone_color_converter.watermark_span(message) * sampling_rate / converter_sr))
+
+def watermark_residual(tone_color_converter, audio, sampling_rate, message="default"):
+    # What add_watermark changes in audio, as a signal at sampling_rate to add onto the track.
+    # Clips converted with watermark=False are marked once this way on the finished mix
+    audio = np.asarray(audio[:watermark_samples(tone_color_converter, sampling_rate, message)], dtype=np.float32)
+    if tone_color_converter.watermark_model is None or len(audio) == 0:
+        return np.zeros(0, dtype=np.float32)
+    converter_sr = tone_color_converter.hps.data.sampling_rate
+    prefix = resample_poly(audio, converter_sr, sampling_rate).astype(np.float32)
+    marked = tone_color_converter.add_watermark(prefix.copy(), message)
+    return resample_poly(marked - prefix, sampling_rate, converter_sr).astype(np.float32)[:len(audio)]
@@ -1,90 +1,168 @@
 import os
+import time
 import torch
+import atexit
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from openvoice import se_extractor
-from openvoice.api import ToneColorConverter
-from transformers import pipeline
+from inference.converter_pool import get_tone_color_converter, watermark_samples, watermark_residual
+from inference.tts_with_voiceclone import generate_speech_batch, generate_speech_fit
+from inference.timeline import Timeline, mix_timelines
+from inference.media_io import is_video, probe_duration, mux_dubbed_audio
+from inference.workspace import ensure_workspace
+from inference.model_registry import get_model_names as registry_model_names
+from inference.token_cache import token_cache_hit_rate
+from inference.render_cache import model_fingerprint, line_key, lookup_lines, store_lines, missing_lines
 import scipy
-from pathlib import Path
+import soundfile
 import srt
-import moviepy.editor as mp
 import numpy as np
 from scipy.signal import resample_poly
-import subprocess
 
 # Output directory setup
 output_dir = './outputs'
 os.makedirs(output_dir, exist_ok=True)
 
+# The synthesis worker pool, created on first use. A request for another worker count replaces it;
+# the old pool is shut down once the requests still using it finish
+synthesis_pool_state = {'pool': None}
+synthesis_pool_lock = threading.Lock()
+
+# Lines cut by more than this to fit their subtitle slot are reported as overflowing
+overflow_tolerance_seconds = 0.01
+
 def get_model_names(model_dir):
-    model_paths = Path(model_dir).glob('*')
-    return [model_path.name for model_path in model_paths if model_path.is_dir()]
+    return registry_model_names(model_dir)
 
 def generate_speech(text, model_path):
-    synthesiser = pipeline("text-to-speech", model=model_path, device=0 if torch.cuda.is_available() else -1)
-    speech = synthesiser(text)
-    
-    resampled_audio = resample_poly(speech["audio"][0], 48000, speech["sampling_rate"])
-    sampling_rate = 48000
-    
-    return sampling_rate, resampled_audio
+    sampling_rate, resampled_audio = generate_speech_many([text], model_path)
+    return sampling_rate, resampled_audio[0]
+
+def generate_speech_many(texts, model_path, sampling_rate=48000, slot_seconds=None):
+    # Uses the shared model cache in tts_with_voiceclone, so each model is loaded once
+    model_dir, model_name = os.path.split(os.path.normpath(model_path))
+    if slot_seconds is None:
+        model_sr, waveforms = generate_speech_batch(texts, model_dir, model_name)
+    else:
+        # Fit-to-slot: each line gets the speaking rate its predicted duration needs
+        waveforms = []
+        for text, max_seconds in zip(texts, slot_seconds):
+            model_sr, waveform, _ = generate_speech_fit(text, model_dir, model_name, max_seconds)
+            waveforms.append(waveform)
+    return sampling_rate, [resample_poly(waveform, sampling_rate, model_sr) for waveform in waveforms]
+
+def slot_seconds_for(jobs, fit_to_slot):
+    if not fit_to_slot:
+        return None
+    return [(sub.end - sub.start).total_seconds() for sub, _ in jobs]
+
+def init_synthesis_worker():
+    # One intra-op thread per worker process so N workers use N cores without oversubscription
+    torch.set_num_threads(1)
+
+def retire_synthesis_pool(pool):
+    # Called with synthesis_pool_lock held; returns the pool if nothing uses it any more
+    if synthesis_pool_state['pool'] is pool:
+        synthesis_pool_state['pool'] = None
+    pool['retired'] = True
+    return pool if pool['users'] == 0 else None
+
+@contextmanager
+def synthesis_pool(num_workers):
+    # Worker processes outlive a single dub_srt call, so each keeps the models it has loaded
+    # and later requests of the same size pull jobs into already-warm workers
+    idle = None
+    with synthesis_pool_lock:
+        pool = synthesis_pool_state['pool']
+        if pool is None or pool['num_workers'] != num_workers:
+            if pool is not None:
+                idle = retire_synthesis_pool(pool)
+            executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=init_synthesis_worker)
+            pool = {'executor': executor, 'num_workers': num_workers, 'users': 0, 'retired': False}
+            synthesis_pool_state['pool'] = pool
+        pool['users'] += 1
+    if idle is not None:
+        idle['executor'].shutdown(wait=False)
+
+    try:
+        yield pool['executor']
+    except BrokenProcessPool:
+        # A worker died; the next request starts a fresh pool
+        with synthesis_pool_lock:
+            retire_synthesis_pool(pool)
+        pool['executor'].shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        with synthesis_pool_lock:
+            pool['users'] -= 1
+            idle = pool if pool['retired'] and pool['users'] == 0 else None
+        if idle is not None:
+            idle['executor'].shutdown(wait=False)
+
+def shutdown_synthesis_pool():
+    with synthesis_pool_lock:
+        pool = synthesis_pool_state['pool']
+        synthesis_pool_state['pool'] = None
+    if pool is not None:
+        pool['executor'].shutdown(wait=True, cancel_futures=True)
+
+atexit.register(shutdown_synthesis_pool)
+
+def synthesize_lines(texts, model_path, sampling_rate, slot_seconds=None):
+    # Runs in a worker process; each worker keeps its own loaded models between jobs
+    return generate_speech_many(texts, model_path, sampling_rate, slot_seconds)[1]
+
+def format_timings(timings):
+    return ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+
+def format_overflows(overflows):
+    return ', '.join(f"#{index} (+{seconds:.2f}s)" for index, seconds in sorted(overflows))
 
 def save_audio(sampling_rate, audio_data, filename="output.wav"):
     audio_data = np.int16(audio_data / np.max(np.abs(audio_data)) * 32767)
     scipy.io.wavfile.write(filename, rate=sampling_rate, data=audio_data)
     return filename
 
-def voice_cloning(speaker_files, reference_speakers, model_version, device_choice, vad_select):
+def voice_cloning(speaker_timelines, reference_speakers, model_version, device_choice, vad_select, workspace=None):
     try:
-        ckpt_converter = f'./OPENVOICE_MODELS/{model_version}'
-        device = "cuda:0" if device_choice == "GPU" and torch.cuda.is_available() else "cpu"
+        workspace = ensure_workspace(workspace, 'dubbing')
+        tone_color_converter = get_tone_color_converter(model_version, device_choice)
+        converter_sr = tone_color_converter.hps.data.sampling_rate
         
-        tone_color_converter = ToneColorConverter(f'{ckpt_converter}/config.json', device=device)
-        tone_color_converter.load_ckpt(f'{ckpt_converter}/checkpoint.pth')
+        cloned_timelines = {}
         
-        cloned_files = {}
-        
-        for speaker_id, base_audio in speaker_files.items():
+        for speaker_id, timeline in speaker_timelines.items():
             if (speaker_id >= len(reference_speakers)) or (reference_speakers[speaker_id] is None):
                 continue
-                
+            
+            # The source embedding only needs the speaker's speech, not the silence between lines
+            base_audio = workspace.file(f'speaker_{speaker_id + 1}_base.wav')
+            soundfile.write(base_audio, timeline.speech(), timeline.sampling_rate)
             source_se, _ = se_extractor.get_se(base_audio, tone_color_converter, vad=vad_select)
             target_se, _ = se_extractor.get_se(reference_speakers[speaker_id], tone_color_converter, vad=vad_select)
             
-            output_path = f'{output_dir}/speaker_{speaker_id + 1}_cloned.wav'
-            tone_color_converter.convert(
-                audio_src_path=base_audio,
-                src_se=source_se,
-                tgt_se=target_se,
-                output_path=output_path
-            )
-            cloned_files[speaker_id] = output_path
+            cloned = Timeline(timeline.sampling_rate, timeline.total_samples)
+            for start_sample, clip, gain in timeline.events:
+                audio = tone_color_converter.convert(
+                    audio_src_path=resample_poly(clip * gain, converter_sr, timeline.sampling_rate).astype(np.float32),
+                    src_se=source_se,
+                    tgt_se=target_se,
+                    watermark=False
+                )
+                cloned.add(start_sample, resample_poly(audio, timeline.sampling_rate, converter_sr)[:len(clip)])
+            cloned_timelines[speaker_id] = cloned
         
-        if cloned_files:
-            max_length = 0
-            sample_rate = None
-            audio_data = {}
-            
-            for speaker_id, file_path in cloned_files.items():
-                sr, audio = scipy.io.wavfile.read(file_path)
-                audio = audio.astype(np.float32) / 32767.0
-                audio_data[speaker_id] = audio
-                max_length = max(max_length, len(audio))
-                sample_rate = sr
-            
-            combined = np.zeros(max_length, dtype=np.float32)
-            for speaker_id, audio in audio_data.items():
-                if np.max(np.abs(audio)) > 0:
-                    normalized_audio = audio / np.max(np.abs(audio))
-                    padded_audio = np.pad(normalized_audio, (0, max_length - len(audio)))
-                    combined += padded_audio
-            
-            if np.max(np.abs(combined)) > 0:
-                combined = combined * 0.9 / np.max(np.abs(combined))
-                combined = np.int16(combined * 32767)
-            
-            final_path = f'{output_dir}/final_dubbed.wav'
-            scipy.io.wavfile.write(final_path, sample_rate, combined)
-            return final_path, "Voice cloning successful!"
+        if cloned_timelines:
+            # Clips are converted unwatermarked and the mixed track is watermarked once, at its start
+            mixed = mix_timelines(cloned_timelines.values(), peak=0.9)
+            prefix = next(mixed.render_blocks(watermark_samples(tone_color_converter, mixed.sampling_rate)), None)
+            if prefix is not None:
+                mixed.add(0, watermark_residual(tone_color_converter, prefix, mixed.sampling_rate))
+            return mixed, "Voice cloning successful!"
         
         return None, "No voices to clone"
         
@@ -98,16 +176,34 @@ def process_srt(srt_file):
         subtitles = list(srt.parse(f.read()))
     return subtitles
 
-def generate_speech_from_srt(srt_file, model_paths, total_duration):
+def place_subtitles(timeline, jobs, speaker_audio, sampling_rate):
+    # Returns (subtitle index, seconds cut) for the lines that did not fit their slot,
+    # e.g. lines that need more than fit_speaking_rate's max_rate
+    overflows = []
+    for (sub, _), audio_data in zip(jobs, speaker_audio):
+        start_sample = int(sub.start.total_seconds() * sampling_rate)
+        end_sample = int(sub.end.total_seconds() * sampling_rate)
+        excess = len(audio_data) - (end_sample - start_sample)
+        if excess > overflow_tolerance_seconds * sampling_rate:
+            overflows.append((sub.index, excess / sampling_rate))
+        timeline.add(start_sample, audio_data[:end_sample - start_sample])
+    return overflows
+
+def generate_speech_from_srt(srt_file, model_paths, total_duration, timings=None, num_workers=1, lines_per_job=8, fit_to_slot=False, overflows=None):
+    timings = {} if timings is None else timings
+    overflows = [] if overflows is None else overflows
+    stage_start = time.perf_counter()
     subtitles = process_srt(srt_file)
     sampling_rate = 48000
     
-    speaker_audio_files = {}
     speaker_timelines = {}
+    speaker_jobs = {}
     
     for speaker_id in range(len(model_paths[1])):
-        speaker_timelines[speaker_id] = np.zeros(int(total_duration * sampling_rate))
+        speaker_timelines[speaker_id] = Timeline(sampling_rate, int(total_duration * sampling_rate))
+        speaker_jobs[speaker_id] = []
     
+    # Group subtitle lines by speaker so each model is loaded once and run in batches
     for sub in subtitles:
         text = sub.content.strip()
         if text:
@@ -121,99 +217,119 @@ def generate_speech_from_srt(srt_file, model_paths, total_duration):
                 speaker_id = 0
             
             if 0 <= speaker_id < len(model_paths[1]):
-                model_path = os.path.join(model_paths[0], model_paths[1][speaker_id])
-                _, audio_data = generate_speech(text, model_path)
-                
-                start_sample = int(sub.start.total_seconds() * sampling_rate)
-                end_sample = int(sub.end.total_seconds() * sampling_rate)
-                subtitle_duration = end_sample - start_sample
-                
-                if len(audio_data) > subtitle_duration:
-                    audio_data = audio_data[:subtitle_duration]
-                else:
-                    audio_data = np.pad(audio_data, (0, subtitle_duration - len(audio_data)))
-                
-                audio_data = audio_data[:subtitle_duration]
-                
-                speaker_timelines[speaker_id][start_sample:end_sample] += audio_data
+                speaker_jobs[speaker_id].append((sub, text.strip()))
+    timings['parse_srt'] = time.perf_counter() - stage_start
     
-    for speaker_id, timeline in speaker_timelines.items():
-        if np.any(timeline):
-            speaker_file = f"{output_dir}/speaker_{speaker_id + 1}_base.wav"
-            save_audio(sampling_rate, timeline, speaker_file)
-            speaker_audio_files[speaker_id] = speaker_file
+    # Lines already rendered with the same model, text and slot are placed straight from the
+    # render cache; only the rest are synthesized
+    stage_start = time.perf_counter()
+    pending_jobs = {}
+    pending_keys = {}
+    for speaker_id, jobs in speaker_jobs.items():
+        model_path = os.path.join(model_paths[0], model_paths[1][speaker_id])
+        slots = slot_seconds_for(jobs, fit_to_slot) or [None] * len(jobs)
+        fingerprint = model_fingerprint(model_path)
+        keys = [line_key(fingerprint, text, max_seconds=slot, sampling_rate=sampling_rate) for (_, text), slot in zip(jobs, slots)]
+        entries = lookup_lines(keys)
+        cached = [i for i, entry in enumerate(entries) if entry is not None]
+        overflows.extend(place_subtitles(speaker_timelines[speaker_id], [jobs[i] for i in cached], [entries[i][1] for i in cached], sampling_rate))
+        missing = missing_lines(entries)
+        pending_jobs[speaker_id] = [jobs[i] for i in missing]
+        pending_keys[speaker_id] = [keys[i] for i in missing]
+    timings['render_cache'] = time.perf_counter() - stage_start
+    num_pending = sum(len(jobs) for jobs in pending_jobs.values())
+    print(f"Render cache: reused {sum(len(jobs) for jobs in speaker_jobs.values()) - num_pending} lines, synthesizing {num_pending}")
     
-    return speaker_audio_files, sampling_rate
-
-def dub_srt(srt_file, media_file, model_dir, model_names, reference_speakers, model_version, device_choice, vad_select, output_type, original_volume, dubbing_volume, clone_voice):
-    if media_file.endswith(('.mp4', '.mkv', '.avi')):
-        media = mp.VideoFileClip(media_file)
+    if num_workers > 1:
+        # Worker processes pull chunks of subtitle lines from the pool queue;
+        # results are placed by subtitle timing as they complete
+        stage_start = time.perf_counter()
+        with synthesis_pool(num_workers) as executor:
+            futures = {}
+            for speaker_id, jobs in pending_jobs.items():
+                model_path = os.path.join(model_paths[0], model_paths[1][speaker_id])
+                for chunk_start in range(0, len(jobs), lines_per_job):
+                    chunk = jobs[chunk_start:chunk_start + lines_per_job]
+                    future = executor.submit(synthesize_lines, [text for _, text in chunk], model_path, sampling_rate,
+                                             slot_seconds_for(chunk, fit_to_slot))
+                    futures[future] = (speaker_id, chunk, pending_keys[speaker_id][chunk_start:chunk_start + lines_per_job])
+            for future in as_completed(futures):
+                speaker_id, chunk, keys = futures[future]
+                speaker_audio = future.result()
+                store_lines(keys, sampling_rate, speaker_audio)
+                overflows.extend(place_subtitles(speaker_timelines[speaker_id], chunk, speaker_audio, sampling_rate))
+        timings['synthesis'] = time.perf_counter() - stage_start
     else:
-        media = mp.AudioFileClip(media_file)
-    total_duration = media.duration
+        for speaker_id, jobs in pending_jobs.items():
+            if not jobs:
+                continue
+            stage_start = time.perf_counter()
+            model_path = os.path.join(model_paths[0], model_paths[1][speaker_id])
+            _, speaker_audio = generate_speech_many([text for _, text in jobs], model_path, sampling_rate,
+                                                   slot_seconds_for(jobs, fit_to_slot))
+            store_lines(pending_keys[speaker_id], sampling_rate, speaker_audio)
+            overflows.extend(place_subtitles(speaker_timelines[speaker_id], jobs, speaker_audio, sampling_rate))
+            timings[f'synthesis_speaker_{speaker_id + 1}'] = time.perf_counter() - stage_start
     
-    speaker_files, sampling_rate = generate_speech_from_srt(
+    speaker_timelines = {speaker_id: timeline for speaker_id, timeline in speaker_timelines.items() if not timeline.is_empty()}
+    return speaker_timelines, sampling_rate
+
+def dub_srt(srt_file, media_file, model_dir, model_names, reference_speakers, model_version, device_choice, vad_select, output_type, original_volume, dubbing_volume, clone_voice, num_workers=1, fit_to_slot=False, workspace=None):
+    workspace = ensure_workspace(workspace, 'dubbing')
+    timings = {}
+    overflows = []
+    stage_start = time.perf_counter()
+    total_duration = probe_duration(media_file)
+    timings['probe_media'] = time.perf_counter() - stage_start
+    
+    speaker_timelines, sampling_rate = generate_speech_from_srt(
         srt_file, 
         (model_dir, model_names), 
-        total_duration
+        total_duration,
+        timings,
+        num_workers=num_workers,
+        fit_to_slot=fit_to_slot,
+        overflows=overflows
     )
+    if not speaker_timelines:
+        return None, "No speech generated from the subtitles"
     
+    stage_start = time.perf_counter()
     if clone_voice:
-        cloned_audio_file, status = voice_cloning(
-            speaker_files,
+        dubbed_audio, status = voice_cloning(
+            speaker_timelines,
             reference_speakers,
             model_version,
             device_choice,
-            vad_select
+            vad_select,
+            workspace
         )
         
-        if cloned_audio_file is None:
+        if dubbed_audio is None:
             return None, status
-        
-        dubbed_audio = mp.AudioFileClip(cloned_audio_file)
+        timings['voice_cloning'] = time.perf_counter() - stage_start
     else:
-        combined_audio_path = f"{output_dir}/combined_speech.wav"
-        combined_audio = np.zeros(int(total_duration * sampling_rate), dtype=np.float32)
-        
-        for speaker_id, audio_file in speaker_files.items():
-            sr, audio = scipy.io.wavfile.read(audio_file)
-            audio = audio.astype(np.float32) / 32767.0
-            combined_audio[:len(audio)] += audio
-        
-        combined_audio = np.int16(combined_audio / np.max(np.abs(combined_audio)) * 32767)
-        scipy.io.wavfile.write(combined_audio_path, sampling_rate, combined_audio)
-        dubbed_audio = mp.AudioFileClip(combined_audio_path)
+        dubbed_audio = mix_timelines(speaker_timelines.values())
+        timings['mix'] = time.perf_counter() - stage_start
     
-    dubbed_audio = dubbed_audio.volumex(dubbing_volume)
-    
-    if output_type == "Video" and media_file.endswith(('.mp4', '.mkv', '.avi')):
-        original_audio = media.audio.volumex(original_volume)
-        final_audio = mp.CompositeAudioClip([original_audio, dubbed_audio])
-        final_video_path = f"{output_dir}/dubbed_video.mp4"
-        
-        if os.path.exists(final_video_path):
-            os.remove(final_video_path)
-        
-        ffmpeg_command = [
-            "ffmpeg",
-            "-i", media_file,
-            "-i", combined_audio_path if not clone_voice else cloned_audio_file,
-            "-filter_complex", f"[0:a]volume={original_volume}[a0];[1:a]volume={dubbing_volume}[a1];[a0][a1]amix=inputs=2:duration=shortest",
-            "-c:v", "copy",
-            "-c:a", "aac",
-            "-map", "0:v:0",
-            "-map", "1:a:0",
-            "-shortest",
-            final_video_path
-        ]
-
-        subprocess.run(ffmpeg_command, check=True)
-
-        return final_video_path, "Dubbing completed!"
+    # The dubbed track is rendered block by block straight into ffmpeg's stdin
+    stage_start = time.perf_counter()
+    if output_type == "Video" and is_video(media_file):
+        final_path = workspace.file("dubbed_video.mp4")
+        mux_dubbed_audio(media_file, dubbed_audio.render_blocks(), sampling_rate, final_path, original_volume, dubbing_volume)
     else:
-        final_audio_path = f"{output_dir}/dubbed_audio.wav"
-        dubbed_audio.write_audiofile(final_audio_path)
-        return final_audio_path, "Dubbing completed!"
+        final_path = workspace.file("dubbed_audio.wav")
+        mux_dubbed_audio(media_file, dubbed_audio.render_blocks(), sampling_rate, final_path, original_volume, dubbing_volume, video=False)
+    timings['mux'] = time.perf_counter() - stage_start
+    print(f"Dubbing timings: {format_timings(timings)}")
+    print(f"Token cache hit rate: {token_cache_hit_rate():.1%}")
+    
+    status = f"Dubbing completed! ({format_timings(timings)})"
+    if overflows:
+        # Lines cut to their slot lose their ending; the subtitles need retiming
+        status += f"\n{len(overflows)} lines were cut to fit their subtitle slots: {format_overflows(overflows)}"
+        print(f"Lines cut to fit their slots: {format_overflows(overflows)}")
+    return final_path, status
 
 if __name__ == "__main__":
     model_dir = "./models_mms"
@@ -0,0 +1,155 @@
+import os
+import json
+import mmap
+import threading
+import numpy as np
+
+# User dictionaries (*.tsv as "word<TAB>pronunciation", *.json as {"word": "pronunciation"})
+# are loaded from lexicon_dir; transliterations computed by the model-based fallback are
+# appended to transliteration_cache_file so each word is transliterated once, ever
+lexicon_dir = './lexicons'
+transliteration_cache_file = os.path.join(lexicon_dir, 'cache', 'transliterations.tsv')
+mmap_threshold = 16 * 1024 * 1024
+
+def normalize_word(word):
+    return word.strip().lower()
+
+def parse_tsv_line(line):
+    line = line.rstrip('\r\n')
+    if not line or line.startswith('#') or '\t' not in line:
+        return None
+    word, pronunciation = line.split('\t', 1)
+    return normalize_word(word), pronunciation.strip()
+
+class MappedLexicon:
+    # A large TSV lexicon sorted by lowercase word stays on disk behind mmap;
+    # only one offset per line is held in memory and lookups binary search the file
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        line_ends = np.flatnonzero(np.frombuffer(self.data, dtype=np.uint8) == ord('\n')) + 1
+        self.starts = np.concatenate(([0], line_ends[line_ends < len(self.data)])).astype(np.int64)
+        self.ends = np.concatenate((self.starts[1:], [len(self.data)])).astype(np.int64)
+
+    def line(self, index):
+        return self.data[self.starts[index]:self.ends[index]].decode('utf-8').rstrip('\r\n')
+
+    def key(self, index):
+        return normalize_word(self.line(index).split('\t', 1)[0])
+
+    def is_sorted(self):
+        previous = ''
+        for index in range(len(self.starts)):
+            key = self.key(index)
+            if key < previous:
+                return False
+            previous = key
+        return True
+
+    def get(self, word, default=None):
+        word = normalize_word(word)
+        low, high = 0, len(self.starts)
+        while low < high:
+            mid = (low + high) // 2
+            if self.key(mid) < word:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.starts):
+            entry = parse_tsv_line(self.line(low))
+            if entry is not None and entry[0] == word:
+                return entry[1]
+        return default
+
+    def __len__(self):
+        return len(self.starts)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class Lexicon:
+    # In-memory entries take precedence over memory-mapped ones; later files override earlier ones
+    def __init__(self, entries=None):
+        self.entries = {normalize_word(word): pronunciation for word, pronunciation in (entries or {}).items()}
+        self.mapped = []
+
+    def add(self, word, pronunciation):
+        self.entries[normalize_word(word)] = pronunciation
+
+    def load(self, path):
+        if path.endswith('.json'):
+            with open(path, 'r', encoding='utf-8') as f:
+                for word, pronunciation in json.load(f).items():
+                    self.add(word, pronunciation)
+        elif path.endswith('.tsv'):
+            if os.path.getsize(path) >= mmap_threshold:
+                mapped = MappedLexicon(path)
+                if mapped.is_sorted():
+                    self.mapped.insert(0, mapped)
+                    return
+                mapped.close()
+                print(f"Lexicon {path} is not sorted by word, loading it into memory")
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    entry = parse_tsv_line(line)
+                    if entry is not None:
+                        self.entries[entry[0]] = entry[1]
+        else:
+            raise ValueError(f"Unsupported lexicon format: {path}")
+
+    def get(self, word, default=None):
+        pronunciation = self.entries.get(normalize_word(word))
+        if pronunciation is not None:
+            return pronunciation
+        for mapped in self.mapped:
+            pronunciation = mapped.get(word)
+            if pronunciation is not None:
+                return pronunciation
+        return default
+
+    def __len__(self):
+        return len(self.entries) + sum(len(mapped) for mapped in self.mapped)
+
+def load_user_lexicons(directory=None):
+    directory = lexicon_dir if directory is None else directory
+    lexicon = Lexicon()
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(('.tsv', '.json')):
+                lexicon.load(os.path.join(directory, name))
+    if len(lexicon):
+        print(f"Loaded {len(lexicon)} lexicon entries from {directory}")
+    return lexicon
+
+class TransliterationCache:
+    # Append-only TSV of word -> transliteration, read once at startup
+    def __init__(self, path=None):
+        self.path = transliteration_cache_file if path is None else path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.rstrip('\r\n')
+                    if '\t' in line:
+                        word, transliteration = line.split('\t', 1)
+                        self.entries[word] = transliteration
+
+    def get(self, word):
+        return self.entries.get(word)
+
+    def put(self, word, transliteration):
+        if '\t' in word or '\n' in word or '\n' in transliteration:
+            return
+        with self.lock:
+            if word in self.entries:
+                return
+            self.entries[word] = transliteration
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(f"{word}\t{transliteration}\n")
+            except OSError as e:
+                print(f"Could not write transliteration cache: {e}")
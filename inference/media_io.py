@@ -0,0 +1,54 @@
+import json
+import subprocess
+import numpy as np
+
+video_extensions = ('.mp4', '.mkv', '.avi')
+
+def is_video(media_file):
+    return media_file.endswith(video_extensions)
+
+def probe_duration(media_file):
+    # Reads the container header only; nothing is decoded
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", media_file],
+        capture_output=True, text=True, check=True
+    )
+    return float(json.loads(result.stdout)["format"]["duration"])
+
+def mux_dubbed_audio(media_file, blocks, sampling_rate, output_path, original_volume, dubbing_volume, video=True):
+    # Pipe the dubbed PCM into a single ffmpeg process through stdin; in video mode the
+    # original video stream is copied, never decoded
+    pcm_input = ["-f", "s16le", "-ar", str(sampling_rate), "-ac", "1", "-i", "pipe:0"]
+    if video:
+        command = [
+            "ffmpeg", "-y",
+            "-i", media_file,
+            *pcm_input,
+            "-filter_complex", f"[0:a]volume={original_volume}[a0];[1:a]volume={dubbing_volume}[a1];[a0][a1]amix=inputs=2:duration=shortest[aout]",
+            "-map", "0:v:0",
+            "-map", "[aout]",
+            "-c:v", "copy",
+            "-c:a", "aac",
+            "-shortest",
+            output_path
+        ]
+    else:
+        command = [
+            "ffmpeg", "-y",
+            *pcm_input,
+            "-filter:a", f"volume={dubbing_volume}",
+            output_path
+        ]
+
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for block in blocks:
+            process.stdin.write((np.clip(block, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+    except BrokenPipeError:
+        pass
+    finally:
+        process.stdin.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return output_path
@@ -0,0 +1,100 @@
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import torch
+
+# Process-wide cache of loaded (model, tokenizer) pairs bounded by the models' parameter bytes.
+# Least recently used models are dropped first, but never while a request holds them
+max_model_bytes = 4 * 1024 * 1024 * 1024
+
+def model_footprint(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+class ModelCache:
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_model_bytes if max_bytes is None else max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading_locks = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+    def lookup(self, key, hold, version):
+        # Called with self.lock held. version identifies the files on disk; an entry with another
+        # version is stale and dropped so the caller reloads it
+        entry = self.entries.get(key)
+        if entry is not None and entry['version'] != version:
+            self.drop(key)
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            entry['holds'] += hold
+        return entry
+
+    def acquire(self, key, load, hold, version=None):
+        with self.lock:
+            entry = self.lookup(key, hold, version)
+            if entry is not None:
+                return entry
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+
+        # Loads of different models run concurrently; a second request for the same model waits for the first
+        with loading_lock:
+            with self.lock:
+                entry = self.lookup(key, hold, version)
+                if entry is not None:
+                    return entry
+
+            model, tokenizer = load()
+            entry = {'model': model, 'tokenizer': tokenizer, 'bytes': model_footprint(model), 'holds': hold, 'version': version}
+            with self.lock:
+                self.stats['misses'] += 1
+                self.entries[key] = entry
+                self.stats['bytes'] += entry['bytes']
+                self.trim()
+        return entry
+
+    def get(self, key, load, version=None):
+        entry = self.acquire(key, load, 0, version)
+        return entry['model'], entry['tokenizer']
+
+    @contextmanager
+    def hold(self, key, load, version=None):
+        entry = self.acquire(key, load, 1, version)
+        try:
+            yield entry['model'], entry['tokenizer']
+        finally:
+            with self.lock:
+                entry['holds'] -= 1
+                self.trim()
+
+    def drop(self, key):
+        # Called with self.lock held. A request still holding the model keeps its own reference
+        entry = self.entries.pop(key)
+        self.stats['bytes'] -= entry['bytes']
+        self.stats['evictions'] += 1
+
+    def trim(self):
+        # Called with self.lock held
+        evicted = False
+        for key in list(self.entries):
+            if self.stats['bytes'] <= self.max_bytes:
+                break
+            entry = self.entries[key]
+            if entry['holds'] > 0:
+                continue
+            self.drop(key)
+            evicted = True
+            print(f"Evicted model {key} ({entry['bytes'] / 1024 / 1024:.0f} MB)")
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry['holds'] == 0]:
+                self.stats['bytes'] -= self.entries.pop(key)['bytes']
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
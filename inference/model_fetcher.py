@@ -0,0 +1,181 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from inference.model_registry import invalidate_models
+
+# Downloads only the files VitsModel/VitsTokenizer.from_pretrained read, straight from the
+# Hugging Face file API. hf_endpoint can point at a mirror or a local HTTP stand-in
+hf_endpoint = os.environ.get('HF_ENDPOINT', 'https://huggingface.co')
+model_files = ('config.json', 'vocab.json', 'tokenizer_config.json', 'special_tokens_map.json', 'added_tokens.json',
+               'model.safetensors', 'pytorch_model.bin')
+max_parallel_files = 4
+chunk_size = 1024 * 1024
+timeout = 30
+
+fetch_jobs = {}
+fetch_lock = threading.Lock()
+
+def open_url(url, headers=None):
+    headers = dict(headers or {})
+    token = os.environ.get('HF_TOKEN')
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+
+def list_model_files(repo_id, revision='main', endpoint=None):
+    endpoint = (endpoint or hf_endpoint).rstrip('/')
+    with open_url(f'{endpoint}/api/models/{repo_id}/tree/{revision}') as response:
+        tree = json.load(response)
+
+    files = {}
+    for entry in tree:
+        if entry.get('type') == 'file' and entry['path'] in model_files:
+            lfs = entry.get('lfs')
+            files[entry['path']] = {
+                'path': entry['path'],
+                'size': lfs['size'] if lfs else entry['size'],
+                # LFS files are checked against their sha256, regular files against their git blob sha1
+                'sha256': lfs['oid'] if lfs else None,
+                'sha1': None if lfs else entry.get('oid'),
+                'url': f'{endpoint}/{repo_id}/resolve/{revision}/{entry["path"]}',
+            }
+
+    if 'model.safetensors' in files:
+        files.pop('pytorch_model.bin', None)
+    for required in ('config.json', 'vocab.json'):
+        if required not in files:
+            raise ValueError(f"{repo_id} has no {required}")
+    if 'model.safetensors' not in files and 'pytorch_model.bin' not in files:
+        raise ValueError(f"{repo_id} has no model weights")
+    return list(files.values())
+
+def download_file(entry, target_dir, progress=None):
+    # Bytes already in the .part file are kept and the rest is requested with a Range header
+    part_path = os.path.join(target_dir, entry['path'] + '.part')
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > entry['size']:
+        # Corrupt, or left from a larger earlier version of the file; start over
+        os.remove(part_path)
+        offset = 0
+    if progress:
+        progress(offset)
+
+    if offset < entry['size'] or entry['size'] == 0:
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        with open_url(entry['url'], headers) as response:
+            if offset and response.status != 206:
+                # The server ignored the range, start over
+                if progress:
+                    progress(-offset)
+                offset = 0
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if progress:
+                        progress(len(chunk))
+
+    verify_file(part_path, entry)
+    final_path = os.path.join(target_dir, entry['path'])
+    os.replace(part_path, final_path)
+    return final_path
+
+def verify_file(path, entry):
+    size = os.path.getsize(path)
+    if size != entry['size']:
+        os.remove(path)
+        raise ValueError(f"{entry['path']}: expected {entry['size']} bytes, got {size}")
+
+    if entry['sha256']:
+        digest = hashlib.sha256()
+        expected = entry['sha256']
+    elif entry['sha1']:
+        digest = hashlib.sha1(f'blob {size}\0'.encode())
+        expected = entry['sha1']
+    else:
+        return
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    if digest.hexdigest() != expected:
+        os.remove(path)
+        raise ValueError(f"{entry['path']}: checksum mismatch")
+
+def fetch_model(repo_id, model_dir, revision='main', endpoint=None, job=None):
+    job = job if job is not None else new_job(repo_id)
+    name = repo_id.split('/')[-1]
+    # Files land in a hidden staging folder (skipped by the registry) and move into place once all are verified
+    staging_dir = os.path.join(model_dir, f'.{name}.download')
+    target_dir = os.path.join(model_dir, name)
+    os.makedirs(staging_dir, exist_ok=True)
+
+    update_job(job, state='listing')
+    files = list_model_files(repo_id, revision, endpoint)
+    update_job(job, state='downloading', total_bytes=sum(entry['size'] for entry in files))
+
+    def progress(num_bytes):
+        with fetch_lock:
+            job['done_bytes'] += num_bytes
+
+    with ThreadPoolExecutor(max_workers=max_parallel_files) as executor:
+        for future in [executor.submit(download_file, entry, staging_dir, progress) for entry in files]:
+            future.result()
+
+    if os.path.isdir(target_dir):
+        for entry in files:
+            os.replace(os.path.join(staging_dir, entry['path']), os.path.join(target_dir, entry['path']))
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    else:
+        os.replace(staging_dir, target_dir)
+    # The registry re-reads the model's mtime, so a cached copy of the old weights is reloaded on next use
+    invalidate_models(model_dir)
+    update_job(job, state='done')
+    return target_dir
+
+def new_job(repo_id):
+    job = {'repo_id': repo_id, 'state': 'queued', 'done_bytes': 0, 'total_bytes': 0, 'error': None}
+    with fetch_lock:
+        fetch_jobs[repo_id] = job
+    return job
+
+def update_job(job, **values):
+    with fetch_lock:
+        job.update(values)
+
+def start_fetch(repo_id, model_dir, revision='main', endpoint=None):
+    # Runs the download on a background thread so the caller (a Gradio handler) returns immediately
+    repo_id = repo_id.strip().strip('/')
+    with fetch_lock:
+        job = fetch_jobs.get(repo_id)
+        if job is not None and job['state'] not in ('done', 'failed'):
+            return job
+    job = new_job(repo_id)
+
+    def run():
+        try:
+            fetch_model(repo_id, model_dir, revision, endpoint, job)
+        except Exception as e:
+            update_job(job, state='failed', error=str(e))
+            print(f"Download of {repo_id} failed: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
+    return job
+
+def describe_job(job):
+    if job['state'] == 'failed':
+        return f"{job['repo_id']}: failed ({job['error']})"
+    if job['state'] == 'downloading' and job['total_bytes']:
+        return (f"{job['repo_id']}: {job['done_bytes'] / job['total_bytes']:.0%} "
+                f"({job['done_bytes'] / 1024 / 1024:.1f}/{job['total_bytes'] / 1024 / 1024:.1f} MB)")
+    return f"{job['repo_id']}: {job['state']}"
+
+def fetch_progress():
+    with fetch_lock:
+        jobs = [dict(job) for job in fetch_jobs.values()]
+    return '\n'.join(describe_job(job) for job in jobs)
@@ -0,0 +1,133 @@
+import os
+import json
+import struct
+import threading
+
+# One cached scan per model directory. A model's metadata is re-read only when the
+# directory listing changes (models added or removed) or the model's own files change
+registries = {}
+registry_lock = threading.Lock()
+
+def safetensors_num_parameters(path):
+    # The safetensors header is a little-endian u64 length followed by JSON tensor shapes,
+    # so the parameter count needs no weights to be loaded
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    num_parameters = 0
+    for name, tensor in header.items():
+        if name != '__metadata__':
+            count = 1
+            for dim in tensor['shape']:
+                count *= dim
+            num_parameters += count
+    return num_parameters
+
+def model_mtime(model_path):
+    # Files rewritten in place do not touch the folder's mtime, so the metadata files are checked too
+    mtimes = [os.path.getmtime(model_path)]
+    for name in ('config.json', 'vocab.json', 'model.safetensors', 'pytorch_model.bin'):
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            mtimes.append(os.path.getmtime(path))
+    return max(mtimes)
+
+def read_model_info(model_path):
+    info = {
+        'name': os.path.basename(model_path),
+        'path': model_path,
+        'mtime': model_mtime(model_path),
+        'sampling_rate': None,
+        'vocab_size': None,
+        'num_speakers': None,
+        'num_parameters': None,
+        'problems': [],
+    }
+
+    config_path = os.path.join(model_path, 'config.json')
+    if os.path.exists(config_path):
+        try:
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            info['sampling_rate'] = config.get('sampling_rate')
+            info['vocab_size'] = config.get('vocab_size')
+            info['num_speakers'] = config.get('num_speakers', 1)
+            if not info['sampling_rate']:
+                info['problems'].append('config.json has no sampling_rate')
+        except (OSError, ValueError) as e:
+            info['problems'].append(f'unreadable config.json ({e})')
+    else:
+        info['problems'].append('missing config.json')
+
+    if not os.path.exists(os.path.join(model_path, 'vocab.json')):
+        info['problems'].append('missing tokenizer (vocab.json)')
+
+    weights_path = os.path.join(model_path, 'model.safetensors')
+    if os.path.exists(weights_path):
+        try:
+            info['num_parameters'] = safetensors_num_parameters(weights_path)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            info['problems'].append(f'unreadable model.safetensors ({e})')
+    elif not os.path.exists(os.path.join(model_path, 'pytorch_model.bin')):
+        info['problems'].append('missing weights (model.safetensors or pytorch_model.bin)')
+
+    return info
+
+def scan_models(model_dir):
+    model_dir = os.path.normpath(model_dir)
+    if not os.path.isdir(model_dir):
+        return {}
+    dir_mtime = os.path.getmtime(model_dir)
+
+    with registry_lock:
+        registry = registries.get(model_dir)
+        if registry is not None and registry['mtime'] == dir_mtime and all(
+                os.path.isdir(info['path']) and model_mtime(info['path']) == info['mtime']
+                for info in registry['models'].values()):
+            return registry['models']
+
+        previous = registry['models'] if registry is not None else {}
+        models = {}
+        for name in sorted(os.listdir(model_dir)):
+            model_path = os.path.join(model_dir, name)
+            # Hidden folders are in-progress downloads
+            if name.startswith('.') or not os.path.isdir(model_path):
+                continue
+            info = previous.get(name)
+            if info is None or info['mtime'] != model_mtime(model_path):
+                info = read_model_info(model_path)
+            models[name] = info
+        registries[model_dir] = {'mtime': dir_mtime, 'models': models}
+        return models
+
+def invalidate_models(model_dir=None):
+    with registry_lock:
+        if model_dir is None:
+            registries.clear()
+        else:
+            registries.pop(os.path.normpath(model_dir), None)
+
+def get_model_names(model_dir):
+    return list(scan_models(model_dir))
+
+def get_model_info(model_name, model_dir):
+    info = scan_models(model_dir).get(model_name)
+    if info is None:
+        raise ValueError(f"Model {model_name} not found in {model_dir}")
+    return info
+
+def check_model(model_name, model_dir):
+    # Surface a broken model folder before from_pretrained fails halfway through loading it
+    info = get_model_info(model_name, model_dir)
+    if info['problems']:
+        raise ValueError(f"Model {model_name} is not usable: {', '.join(info['problems'])}")
+    return info
+
+def preload_models(model_names, model_dir):
+    from inference.tts_with_voiceclone import load_vits_model  # Imported here to avoid a circular import
+    for model_name in model_names:
+        try:
+            load_vits_model(model_name, model_dir)
+            print(f"Preloaded model {model_name}")
+        except Exception as e:
+            print(f"Could not preload model {model_name}: {e}")
@@ -1,73 +1,36 @@
 import os
 import torch
-from transformers import VitsModel, VitsTokenizer
 from openvoice import se_extractor
-from openvoice.api import ToneColorConverter
+from inference.converter_pool import get_tone_color_converter, watermark_residual
+from inference.workspace import ensure_workspace
+from inference.model_registry import get_model_names as registry_model_names
+from inference.token_cache import token_cache_hit_rate
+from inference.tts_with_voiceclone import generate_speech_cached
 import scipy
-from pathlib import Path
+import soundfile
 import numpy as np
+from scipy.signal import resample_poly
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 output_dir = './outputs'
 os.makedirs(output_dir, exist_ok=True)
 
-models = {}
-tokenizers = {}
-
 def get_model_names(model_dir):
-    model_paths = Path(model_dir).glob('*')
-    return [model_path.name for model_path in model_paths if model_path.is_dir()]
-
-def load_vits_model(model_name, model_dir):
-    if model_name not in models:
-        model_path = os.path.join(model_dir, model_name)
-        models[model_name] = VitsModel.from_pretrained(model_path).to(device)
-        tokenizers[model_name] = VitsTokenizer.from_pretrained(model_path)
-    return models[model_name], tokenizers[model_name]
-
-def generate_speech(text, model_dir, model_name, speaking_rate=1.0):
-    model, tokenizer = load_vits_model(model_name, model_dir)
-    processed_string = (text)
-    inputs = tokenizer(processed_string, return_tensors="pt")
-    
-    # Move inputs to device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    
-    #set_seed(456)
-    
-    # Set model parameters
-    model.speaking_rate = speaking_rate
-    
-    with torch.no_grad():
-        outputs = model(**inputs)
-    
-    # Move output back to CPU for audio processing
-    waveform = outputs.waveform[0].cpu().numpy()
-    
-    # Ensure correct sampling rate
-    if hasattr(model.config, 'sampling_rate'):
-        sampling_rate = model.config.sampling_rate
-    else:
-        sampling_rate = 48000
-    
-    return sampling_rate, waveform
+    return registry_model_names(model_dir)
 
 def save_audio(sampling_rate, audio_data, filename="output.wav"):
     scipy.io.wavfile.write(filename, rate=sampling_rate, data=audio_data)
     return filename
 
-def voice_cloning(base_speaker, reference_speaker, model_version, device_choice, vad_select):
+def voice_cloning(base_speaker, reference_speaker, model_version, device_choice, vad_select, workspace=None):
     try:
-        ckpt_converter = f'./OPENVOICE_MODELS/{model_version}'
-        device = "cuda:0" if device_choice == "GPU" and torch.cuda.is_available() else "cpu"
-        
-        tone_color_converter = ToneColorConverter(f'{ckpt_converter}/config.json', device=device)
-        tone_color_converter.load_ckpt(f'{ckpt_converter}/checkpoint.pth')
+        workspace = ensure_workspace(workspace, 'podcast')
+        tone_color_converter = get_tone_color_converter(model_version, device_choice)
 
         source_se, _ = se_extractor.get_se(base_speaker, tone_color_converter, vad=vad_select)
         target_se, _ = se_extractor.get_se(reference_speaker, tone_color_converter, vad=vad_select)
         
-        save_path = f'{output_dir}/output_cloned_podtts.wav'
+        save_path = workspace.file('output_cloned_podtts.wav')
         
         tone_color_converter.convert(
             audio_src_path=base_speaker, 
@@ -79,23 +42,104 @@ def voice_cloning(base_speaker, reference_speaker, model_version, device_choice,
     except Exception as e:
         return None, f"Error: {str(e)}"
 
-def generate_podcast_script(script, model_dir, model_names, speaking_rate=1.0, noise_scale=1, clone=False, reference_speakers=None, model_version="v2", device_choice="GPU", vad_select=False):
-    lines = script.split('\n')
-    audio_segments = []
-    
-    for line in lines:
+def parse_podcast_script(script):
+    # "Speaker N: text" lines -> [(speaker_index, text)] in script order
+    script_lines = []
+    for line in script.split('\n'):
         if line.strip():
             speaker, text = line.split(':', 1)
-            model_name = model_names[int(speaker.strip().split()[-1]) - 1]
-            sr, audio = generate_speech(text.strip(), model_dir, model_name, speaking_rate)
-            audio_segments.append(audio)
-    
-    combined_audio = np.concatenate(audio_segments)
-    output_path = f'{output_dir}/podcast_output.wav'
+            script_lines.append((int(speaker.strip().split()[-1]) - 1, text.strip()))
+    return script_lines
+
+def clone_speaker_lines(clips, sampling_rate, reference_speaker, tone_color_converter, vad_select, base_audio):
+    # One source embedding per speaker from all of their lines; embeddings are cached by get_se
+    converter_sr = tone_color_converter.hps.data.sampling_rate
+    soundfile.write(base_audio, np.concatenate(clips), sampling_rate)
+    source_se, _ = se_extractor.get_se(base_audio, tone_color_converter, vad=vad_select)
+    target_se, _ = se_extractor.get_se(reference_speaker, tone_color_converter, vad=vad_select)
+
+    cloned = []
+    for clip in clips:
+        audio = tone_color_converter.convert(
+            audio_src_path=resample_poly(clip, converter_sr, sampling_rate).astype(np.float32),
+            src_se=source_se,
+            tgt_se=target_se,
+            watermark=False
+        )
+        cloned.append(resample_poly(audio, sampling_rate, converter_sr).astype(np.float32))
+    return cloned
+
+def assemble_lines(clips, sampling_rate, gap_seconds=0.0, crossfade_ms=0):
+    fade_len = int(sampling_rate * crossfade_ms / 1000)
+    gap = np.zeros(int(sampling_rate * gap_seconds), dtype=np.float32)
+    pieces = []
+    for clip in clips:
+        clip = np.array(clip, dtype=np.float32)
+        n = min(fade_len, len(clip) // 2)
+        if n and len(gap):
+            # Separated lines get short fade-in/out ramps so they do not click against the gap
+            ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+            clip[:n] *= ramp
+            clip[len(clip) - n:] *= ramp[::-1]
+        elif n and pieces:
+            # Back-to-back lines overlap by the crossfade length
+            previous = pieces[-1]
+            n = min(n, len(previous))
+            fade_in = np.linspace(0.0, 1.0, n, dtype=np.float32)
+            clip[:n] = clip[:n] * fade_in + previous[len(previous) - n:] * (1.0 - fade_in)
+            pieces[-1] = previous[:len(previous) - n]
+        if pieces and len(gap):
+            pieces.append(gap)
+        pieces.append(clip)
+    return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+
+def generate_podcast_script(script, model_dir, model_names, speaking_rate=1.0, noise_scale=None, clone=False, reference_speakers=None, model_version="v2", device_choice="GPU", vad_select=False, workspace=None, gap_seconds=0.0, crossfade_ms=0):
+    workspace = ensure_workspace(workspace, 'podcast')
+    script_lines = parse_podcast_script(script)
+    if not script_lines:
+        return None, "Empty podcast script"
+
+    # Group lines by speaker and synthesize each speaker's lines as one batch;
+    # lines unchanged since an earlier render are spliced in from the render cache
+    speaker_lines = {}
+    for index, (speaker_idx, text) in enumerate(script_lines):
+        speaker_lines.setdefault(speaker_idx, []).append(index)
+
+    clips = [None] * len(script_lines)
+    sr = None
+    tone_color_converter = None
+    synthesized = 0
+    for speaker_idx, indices in speaker_lines.items():
+        model_name = model_names[speaker_idx]
+        model_sr, waveforms, num_synthesized = generate_speech_cached([script_lines[i][1] for i in indices], model_dir, model_name,
+                                                                      speaking_rate, noise_scale)
+        synthesized += num_synthesized
+        # Speakers can use models with different rates; the first one sets the podcast rate
+        sr = sr or model_sr
+        if model_sr != sr:
+            waveforms = [resample_poly(waveform, sr, model_sr).astype(np.float32) for waveform in waveforms]
+
+        if clone and reference_speakers and speaker_idx < len(reference_speakers) and reference_speakers[speaker_idx]:
+            try:
+                tone_color_converter = get_tone_color_converter(model_version, device_choice)
+                waveforms = clone_speaker_lines(waveforms, sr, reference_speakers[speaker_idx], tone_color_converter,
+                                                vad_select, workspace.file(f'speaker_{speaker_idx + 1}_base.wav'))
+            except Exception as e:
+                return None, f"Error: {str(e)}"
+
+        for i, waveform in zip(indices, waveforms):
+            clips[i] = waveform
+
+    combined_audio = assemble_lines(clips, sr, gap_seconds, crossfade_ms)
+    if tone_color_converter is not None:
+        # Cloned lines are converted unwatermarked and the assembled podcast is watermarked once, at its start
+        residual = watermark_residual(tone_color_converter, combined_audio, sr)
+        combined_audio[:len(residual)] += residual
+    output_path = workspace.file('podcast_output.wav')
     save_audio(sr, combined_audio, output_path)
-    
+    rendered = f"synthesized {synthesized} of {len(script_lines)} lines"
+    print(f"Podcast: {rendered}, token cache hit rate {token_cache_hit_rate():.1%}")
+
     if clone and reference_speakers:
-        cloned_audio_file, status = voice_cloning(output_path, reference_speakers[0], model_version, device_choice, vad_select)
-        return cloned_audio_file, status
-    
-    return output_path, "Podcast generation successful!"
+        return output_path, f"Voice cloning successful! ({rendered})"
+    return output_path, f"Podcast generation successful! ({rendered})"
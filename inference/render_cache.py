@@ -0,0 +1,127 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from openvoice.file_cache import store_file, evict_files, touch
+
+# Process-wide caches of synthesized audio. Lines are keyed by everything that shapes the waveform,
+# so re-rendering an edited script only synthesizes the lines that changed
+max_cache_bytes = 512 * 1024 * 1024
+
+# Seeded generate_speech results are content-addressed on disk, so they survive restarts. They keep
+# their own memory budget so a large script render does not push them out
+waveform_cache_dir = './outputs/cache/waveforms'
+waveform_cache_memory_bytes = 128 * 1024 * 1024
+waveform_cache_max_bytes = 2 * 1024 * 1024 * 1024
+
+class WaveformCache:
+    # LRU of (sampling_rate, waveform) bounded by the waveforms' bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'bytes': 0}
+
+    def lookup(self, keys):
+        # [(sampling_rate, waveform) or None] in key order
+        entries = []
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                else:
+                    self.stats['misses'] += 1
+                entries.append(entry)
+        return entries
+
+    def store(self, keys, sampling_rate, waveforms):
+        with self.lock:
+            for key, waveform in zip(keys, waveforms):
+                waveform = np.asarray(waveform, dtype=np.float32)
+                if waveform.nbytes > self.max_bytes:
+                    continue
+                previous = self.entries.pop(key, None)
+                if previous is not None:
+                    self.stats['bytes'] -= previous[1].nbytes
+                self.entries[key] = (sampling_rate, waveform)
+                self.stats['bytes'] += waveform.nbytes
+
+            # Drop the least recently used entries beyond the byte budget
+            while self.stats['bytes'] > self.max_bytes:
+                _, (_, waveform) = self.entries.popitem(last=False)
+                self.stats['bytes'] -= waveform.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats['bytes'] = 0
+
+render_cache = WaveformCache(max_cache_bytes)
+waveform_cache = WaveformCache(waveform_cache_memory_bytes)
+
+def line_key(fingerprint, text, speaking_rate=1.0, noise_scale=None, noise_scale_duration=None, max_seconds=None, sampling_rate=None):
+    # fingerprint is model_fingerprint(model_path), computed once per script rather than per line;
+    # max_seconds is set for fit-to-slot lines, whose speaking rate depends on the slot length;
+    # sampling_rate for lines stored resampled rather than at the model's own rate
+    return (fingerprint, text, float(speaking_rate), noise_scale, noise_scale_duration, max_seconds, sampling_rate)
+
+def lookup_lines(keys):
+    return render_cache.lookup(keys)
+
+def store_lines(keys, sampling_rate, waveforms):
+    render_cache.store(keys, sampling_rate, waveforms)
+
+def missing_lines(entries):
+    return [i for i, entry in enumerate(entries) if entry is None]
+
+def clear_render_cache():
+    render_cache.clear()
+    waveform_cache.clear()
+
+def model_fingerprint(model_path):
+    # Retrained or re-downloaded weights get new cache entries, in both the line and the waveform cache
+    fingerprint = [os.path.abspath(model_path)]
+    for name in sorted(os.listdir(model_path)) if os.path.isdir(model_path) else []:
+        if name.endswith(('.safetensors', '.bin', '.json')):
+            stat = os.stat(os.path.join(model_path, name))
+            fingerprint.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+def waveform_key(model_path, text, speaking_rate, noise_scale, noise_scale_duration, seed):
+    request = [model_fingerprint(model_path), text, float(speaking_rate), noise_scale, noise_scale_duration, seed]
+    return hashlib.sha256(json.dumps(request, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def waveform_cache_path(digest):
+    return os.path.join(waveform_cache_dir, digest[:2], f'{digest}.npz')
+
+def load_waveform(digest):
+    entry = waveform_cache.lookup([digest])[0]
+    if entry is not None:
+        return entry
+
+    path = waveform_cache_path(digest)
+    try:
+        with np.load(path) as data:
+            entry = int(data['sampling_rate']), data['waveform']
+    except (OSError, KeyError, ValueError):
+        return None
+    touch(path)
+    with waveform_cache.lock:
+        waveform_cache.stats['disk_hits'] += 1
+    waveform_cache.store([digest], entry[0], [entry[1]])
+    return entry
+
+def save_waveform(digest, sampling_rate, waveform):
+    waveform = np.asarray(waveform, dtype=np.float32)
+    waveform_cache.store([digest], sampling_rate, [waveform])
+    store_file(waveform_cache_path(digest), lambda f: np.savez(f, sampling_rate=sampling_rate, waveform=waveform),
+               waveform_cache_dir, '.npz', max_bytes=waveform_cache_max_bytes)
+
+def evict_waveform_cache(max_bytes=None):
+    max_bytes = waveform_cache_max_bytes if max_bytes is None else max_bytes
+    if os.path.isdir(waveform_cache_dir):
+        evict_files(waveform_cache_dir, '.npz', max_bytes=max_bytes)
@@ -1,107 +1,160 @@
 import os
 import re
-from pythainlp import word_tokenize
+from functools import lru_cache
+from pythainlp.tokenize import sent_tokenize
+from inference.lexicon import load_user_lexicons, TransliterationCache
+
+try:
+    from pythainlp import transliterate
+except ImportError:
+    transliterate = None
 
 # Ensure UTF-8 encoding is set
 os.environ['PYTHONIOENCODING'] = 'utf-8'
 
+english_lexicon = {
+    "today": "ทูเด",
+    "hello": "เฮลโล",
+    "world": "เวิลด์",
+    "computer": "คอมพิวเตอร์",
+    "phone": "โฟน",
+    "school": "สคูล",
+    "teacher": "ทีเชอร์",
+    "student": "สตูเดนท์",
+    "apple": "แอปเปิล",
+    "orange": "ออเรนจ์",
+    "table": "เทเบิล",
+    "chair": "แชร์",
+    "window": "วินโดว์",
+    "door": "ดอร์",
+    "water": "วอเทอร์",
+    "coffee": "คอฟฟี่",
+    "milk": "มิลค์",
+    "juice": "จูซ",
+    "food": "ฟูด",
+    "car": "คาร์",
+    "bus": "บัส",
+    "train": "เทรน",
+    "airplane": "แอร์เพลน",
+    "boat": "โบ๊ท",
+    "dog": "ด็อก",
+    "cat": "แคท",
+    "bird": "เบิร์ด",
+    "fish": "ฟิช",
+    "house": "เฮ้าส์",
+    "city": "ซิตี้",
+    "country": "คันทรี",
+    "family": "แฟมิลี",
+    "friend": "เฟรนด์",
+    "love": "เลิฟ",
+    "happiness": "แฮปปิเนส",
+    "sadness": "แซดเนส",
+    "anger": "แองเกอร์",
+    "smile": "สไมล์",
+    "cry": "คราย",
+    "laugh": "ลาฟ",
+    "light": "ไลท์",
+    "dark": "ดาร์ก",
+    "sun": "ซัน",
+    "moon": "มูน",
+    "star": "สตาร์",
+    "ocean": "โอเชียน",
+    "mountain": "เมาเทน",
+    "river": "ริเวอร์",
+    "forest": "ฟอเรสต์",
+    "i": "ไอ",
+    "you": "ยู",
+    "talk": "ทอล์ก",
+    "sing": "ซิง",
+    "dance": "แดนซ์",
+    "read": "รีด",
+    "write": "ไรท์",
+    "run": "รัน",
+    "walk": "วอล์ค",
+    "jump": "จัมป์",
+    "swim": "สวิม",
+    "eat": "อีท",
+    "drink": "ดริงค์",
+    "sleep": "สลีป",
+    "wake": "เวค",
+    "good": "กู๊ด",
+    "bad": "แบด",
+    "happy": "แฮปปี้",
+    "sad": "แซด",
+    "angry": "แองกรี",
+    "tired": "ไทร์ด"
+}
+
+class ThaiTextFrontend:
+    # Regexes are compiled once and English words are transliterated once per distinct word,
+    # so cleaning cost stays small next to synthesis even for long subtitle files
+    sara_am = re.compile(r'([ก-ฮ])ำ')
+    # Latin runs as pythainlp's newmm tokenizer splits them; only runs with a letter are transliterated
+    english_word = re.compile(r'[-a-zA-Z]*[a-zA-Z][-a-zA-Z]*')
+
+    def __init__(self, lexicon=None, transliteration_cache=None, cache_size=65536):
+        # User dictionaries win over the model-based transliterator, whose results persist on disk;
+        # english_lexicon remains the last resort when transliteration fails
+        self.lexicon = load_user_lexicons() if lexicon is None else lexicon
+        self.transliteration_cache = TransliterationCache() if transliteration_cache is None else transliteration_cache
+        self.transliterate_word = lru_cache(maxsize=cache_size)(self._transliterate_word)
+
+    def _transliterate_word(self, word):
+        pronunciation = self.lexicon.get(word)
+        if pronunciation is None:
+            pronunciation = self.transliteration_cache.get(word)
+        if pronunciation is not None:
+            return pronunciation
+        try:
+            pronunciation = transliterate(word, engine='ipa')
+        except Exception:
+            return english_to_thai_fallback(word)
+        self.transliteration_cache.put(word, pronunciation)
+        return pronunciation
+
+    def clean(self, text):
+        # Replace occurrences of ำ with ํา
+        text = self.sara_am.sub('\\1\u0E4Dา', text)
+        # Convert English words to Thai phonemes
+        return self.english_word.sub(lambda match: self.transliterate_word(match.group(0)), text)
+
+    def clean_many(self, texts):
+        # Repeated lines (common in subtitles and scripts) are cleaned once
+        cleaned = {}
+        for text in texts:
+            if text not in cleaned:
+                cleaned[text] = self.clean(text)
+        return [cleaned[text] for text in texts]
+
+frontend = ThaiTextFrontend()
+
 def english_to_thai_fallback(word):
-    mapping = {
-        "today": "ทูเด",
-        "hello": "เฮลโล",
-        "world": "เวิลด์",
-        "computer": "คอมพิวเตอร์",
-        "phone": "โฟน",
-        "school": "สคูล",
-        "teacher": "ทีเชอร์",
-        "student": "สตูเดนท์",
-        "apple": "แอปเปิล",
-        "orange": "ออเรนจ์",
-        "table": "เทเบิล",
-        "chair": "แชร์",
-        "window": "วินโดว์",
-        "door": "ดอร์",
-        "water": "วอเทอร์",
-        "coffee": "คอฟฟี่",
-        "milk": "มิลค์",
-        "juice": "จูซ",
-        "food": "ฟูด",
-        "car": "คาร์",
-        "bus": "บัส",
-        "train": "เทรน",
-        "airplane": "แอร์เพลน",
-        "boat": "โบ๊ท",
-        "dog": "ด็อก",
-        "cat": "แคท",
-        "bird": "เบิร์ด",
-        "fish": "ฟิช",
-        "house": "เฮ้าส์",
-        "city": "ซิตี้",
-        "country": "คันทรี",
-        "family": "แฟมิลี",
-        "friend": "เฟรนด์",
-        "love": "เลิฟ",
-        "happiness": "แฮปปิเนส",
-        "sadness": "แซดเนส",
-        "anger": "แองเกอร์",
-        "smile": "สไมล์",
-        "cry": "คราย",
-        "laugh": "ลาฟ",
-        "light": "ไลท์",
-        "dark": "ดาร์ก",
-        "sun": "ซัน",
-        "moon": "มูน",
-        "star": "สตาร์",
-        "ocean": "โอเชียน",
-        "mountain": "เมาเทน",
-        "river": "ริเวอร์",
-        "forest": "ฟอเรสต์",
-        "i": "ไอ",
-        "love": "เลิฟ",
-        "you": "ยู",
-        "talk": "ทอล์ก",
-        "sing": "ซิง",
-        "dance": "แดนซ์",
-        "read": "รีด",
-        "write": "ไรท์",
-        "run": "รัน",
-        "walk": "วอล์ค",
-        "jump": "จัมป์",
-        "swim": "สวิม",
-        "eat": "อีท",
-        "drink": "ดริงค์",
-        "sleep": "สลีป",
-        "wake": "เวค",
-        "good": "กู๊ด",
-        "bad": "แบด",
-        "happy": "แฮปปี้",
-        "sad": "แซด",
-        "angry": "แองกรี",
-        "tired": "ไทร์ด"
-    }
-    return mapping.get(word.lower(), word)
+    return english_lexicon.get(word.lower(), word)
 
 def clean_thai_text(text):
-    def replace_mai_ek(match):
-        return match.group(1) + '\u0E4D' + 'า'  # Replace ำ with ํ + า
-
-    # Replace occurrences of ำ with ํา
-    text = re.sub(r'([ก-ฮ])ำ', replace_mai_ek, text)
-    
-    # Tokenize the text
-    words = word_tokenize(text, keep_whitespace=True)
+    return frontend.clean(text)
 
-    # Convert English words to Thai phonemes
-    cleaned_text = []
-    for word in words:
-        if re.search(r'[a-zA-Z]', word):  # If the word contains English letters
-            try:
-                from pythainlp import transliterate  # Import here to handle the library conditionally
-                thai_phoneme = transliterate(word, engine='ipa')
-                cleaned_text.append(thai_phoneme)
-            except Exception:
-                cleaned_text.append(english_to_thai_fallback(word))
-        else:
-            cleaned_text.append(word)
+def clean_many(texts):
+    return frontend.clean_many(texts)
 
-    return ''.join(cleaned_text)
+def split_thai_sentences(text, max_chars=120):
+    # Split at sentence boundaries, then break long sentences at phrase (space) boundaries.
+    # sent_tokenize's default crfcut engine needs python-crfsuite (listed in requirements.txt)
+    chunks = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        for sentence in sent_tokenize(line.strip()):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            current = ''
+            for phrase in sentence.split(' '):
+                if current and len(current) + len(phrase) + 1 > max_chars:
+                    chunks.append(current)
+                    current = phrase
+                else:
+                    current = f'{current} {phrase}' if current else phrase
+            if current:
+                chunks.append(current)
+    return chunks
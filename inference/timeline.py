@@ -0,0 +1,93 @@
+import numpy as np
+import soundfile
+
+class Timeline:
+    # Sparse audio track: (start_sample, clip, gain) events rendered block by block,
+    # so memory follows the amount of speech rather than the length of the media
+    def __init__(self, sampling_rate, total_samples):
+        self.sampling_rate = sampling_rate
+        self.total_samples = total_samples
+        self.events = []
+
+    def add(self, start_sample, clip, gain=1.0):
+        clip = np.asarray(clip, dtype=np.float32)
+        end_sample = min(start_sample + len(clip), self.total_samples)
+        if end_sample > start_sample:
+            self.events.append((start_sample, clip[:end_sample - start_sample], gain))
+
+    def is_empty(self):
+        return not any(np.any(clip) for _, clip, _ in self.events)
+
+    def clusters(self):
+        # Groups of overlapping events, each as (start_sample, end_sample, events)
+        events = sorted(self.events, key=lambda event: event[0])
+        cluster = []
+        cluster_start = cluster_end = 0
+        for event in events:
+            start_sample, clip, _ = event
+            if cluster and start_sample >= cluster_end:
+                yield cluster_start, cluster_end, cluster
+                cluster = []
+            if not cluster:
+                cluster_start = cluster_end = start_sample
+            cluster.append(event)
+            cluster_end = max(cluster_end, start_sample + len(clip))
+        if cluster:
+            yield cluster_start, cluster_end, cluster
+
+    def peak(self):
+        peak = 0.0
+        for cluster_start, cluster_end, events in self.clusters():
+            mixed = np.zeros(cluster_end - cluster_start, dtype=np.float32)
+            for start_sample, clip, gain in events:
+                offset = start_sample - cluster_start
+                mixed[offset:offset + len(clip)] += clip * gain
+            peak = max(peak, float(np.max(np.abs(mixed))))
+        return peak
+
+    def render_blocks(self, block_size=48000, gain=1.0):
+        events = sorted(self.events, key=lambda event: event[0])
+        next_event = 0
+        active = []
+        for block_start in range(0, self.total_samples, block_size):
+            block_end = min(block_start + block_size, self.total_samples)
+            while next_event < len(events) and events[next_event][0] < block_end:
+                active.append(events[next_event])
+                next_event += 1
+
+            block = np.zeros(block_end - block_start, dtype=np.float32)
+            for start_sample, clip, event_gain in active:
+                lo = max(start_sample, block_start)
+                hi = min(start_sample + len(clip), block_end)
+                if hi > lo:
+                    block[lo - block_start:hi - block_start] += clip[lo - start_sample:hi - start_sample] * (event_gain * gain)
+            active = [event for event in active if event[0] + len(event[1]) > block_end]
+            yield block
+
+    def speech(self):
+        # The speaker's clips back to back, without the silence between them
+        events = sorted(self.events, key=lambda event: event[0])
+        if not events:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate([clip * gain for _, clip, gain in events])
+
+    def write(self, filename, gain=1.0, block_size=48000, subtype='PCM_16'):
+        with soundfile.SoundFile(filename, 'w', samplerate=self.sampling_rate, channels=1, subtype=subtype) as f:
+            for block in self.render_blocks(block_size, gain):
+                f.write(np.clip(block, -1.0, 1.0))
+        return filename
+
+def mix_timelines(timelines, peak=1.0, normalize_each=True):
+    # Merge speaker timelines into one, normalizing each speaker and then the mix
+    timelines = [timeline for timeline in timelines if timeline.events]
+    mixed = Timeline(timelines[0].sampling_rate, max(t.total_samples for t in timelines))
+    for timeline in timelines:
+        speaker_peak = timeline.peak() if normalize_each else 1.0
+        speaker_gain = 1.0 / speaker_peak if speaker_peak > 0 else 1.0
+        for start_sample, clip, gain in timeline.events:
+            mixed.add(start_sample, clip, gain * speaker_gain)
+
+    mixed_peak = mixed.peak()
+    if mixed_peak > 0:
+        mixed.events = [(start_sample, clip, gain * peak / mixed_peak) for start_sample, clip, gain in mixed.events]
+    return mixed
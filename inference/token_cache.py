@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+import torch
+
+# Process-wide LRU from raw text to VITS token ids. Scripts repeat short lines a lot,
+# so tts, podcast and dubbing share it through the synthesis functions in tts_with_voiceclone
+max_cached_texts = 16384
+
+token_cache = OrderedDict()
+token_cache_lock = threading.Lock()
+token_cache_stats = {'hits': 0, 'misses': 0}
+
+def tokenizer_key(tokenizer):
+    # The same text tokenizes differently under another vocabulary or normalization setting
+    return (tokenizer.name_or_path, len(tokenizer), getattr(tokenizer, 'normalize', None),
+            getattr(tokenizer, 'add_blank', None), getattr(tokenizer, 'phonemize', None),
+            getattr(tokenizer, 'is_uroman', None))
+
+def token_ids(tokenizer, text):
+    key = (tokenizer_key(tokenizer), text)
+    with token_cache_lock:
+        ids = token_cache.get(key)
+        if ids is not None:
+            token_cache.move_to_end(key)
+            token_cache_stats['hits'] += 1
+            return ids
+        token_cache_stats['misses'] += 1
+
+    ids = tuple(tokenizer(text)["input_ids"])
+    with token_cache_lock:
+        token_cache[key] = ids
+        while len(token_cache) > max_cached_texts:
+            token_cache.popitem(last=False)
+    return ids
+
+def tokenize(tokenizer, text):
+    # Same tensors as tokenizer(text, return_tensors="pt") for a single text
+    input_ids = torch.tensor([token_ids(tokenizer, text)], dtype=torch.long)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+def token_cache_hit_rate():
+    with token_cache_lock:
+        lookups = token_cache_stats['hits'] + token_cache_stats['misses']
+        return token_cache_stats['hits'] / lookups if lookups else 0.0
+
+def clear_token_cache():
+    with token_cache_lock:
+        token_cache.clear()
+        token_cache_stats['hits'] = token_cache_stats['misses'] = 0
@@ -1,10 +1,18 @@
 import os
+import time
+import threading
+from contextlib import contextmanager
 import torch
 from openvoice import se_extractor
-from openvoice.api import ToneColorConverter
+from inference.converter_pool import get_tone_color_converter
+from inference.thaicleantext import split_thai_sentences
+from inference.workspace import ensure_workspace
+from inference.model_registry import get_model_names as registry_model_names, check_model
+from inference.model_cache import ModelCache
+from inference.token_cache import token_ids, tokenize
+from inference.render_cache import model_fingerprint, line_key, lookup_lines, store_lines, missing_lines, waveform_key, load_waveform, save_waveform
 from transformers import VitsModel, VitsTokenizer
 import scipy
-from pathlib import Path
 import numpy as np
 from scipy.signal import resample_poly
 
@@ -12,67 +20,267 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 output_dir = './outputs'
 os.makedirs(output_dir, exist_ok=True)
 
-models = {}
-tokenizers = {}
+model_cache = ModelCache()
+model_locks = {}
+
+def model_lock(model_name):
+    # speaking_rate is set on the shared model before each forward pass, so requests
+    # for the same model take turns while different models run concurrently
+    return model_locks.setdefault(model_name, threading.Lock())
+
+class RngLock:
+    # torch's default generator is process-wide. Unseeded passes only need it not to be reseeded
+    # under them, so they share it; a seeded pass holds it alone from the seed through its last draw
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared_count = 0
+        self.exclusive_held = False
+        self.exclusive_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.exclusive_held or self.exclusive_waiting:
+                self.condition.wait()
+            self.shared_count += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared_count -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def seeded(self, seed):
+        with self.condition:
+            self.exclusive_waiting += 1
+            while self.exclusive_held or self.shared_count:
+                self.condition.wait()
+            self.exclusive_waiting -= 1
+            self.exclusive_held = True
+        try:
+            # fork_rng restores the generator afterwards, so later unseeded synthesis does not start from a fixed state
+            with torch.random.fork_rng(devices=[torch.cuda.current_device()] if device.type == 'cuda' else []):
+                torch.manual_seed(seed)
+                yield
+        finally:
+            with self.condition:
+                self.exclusive_held = False
+                self.condition.notify_all()
+
+    def hold(self, seed=None):
+        return self.shared() if seed is None else self.seeded(seed)
+
+rng_lock = RngLock()
+
+def set_noise(model, noise_scale=None, noise_scale_duration=None):
+    # None restores the model's configured value, so one request's noise settings never leak into the next
+    model.noise_scale = model.config.noise_scale if noise_scale is None else noise_scale
+    model.noise_scale_duration = model.config.noise_scale_duration if noise_scale_duration is None else noise_scale_duration
 
 def get_model_names(model_dir):
-    model_paths = Path(model_dir).glob('*')
-    return [model_path.name for model_path in model_paths if model_path.is_dir()]
+    return registry_model_names(model_dir)
+
+def read_vits_model(model_name, model_dir):
+    model_path = check_model(model_name, model_dir)['path']
+    return VitsModel.from_pretrained(model_path).to(device), VitsTokenizer.from_pretrained(model_path)
 
 def load_vits_model(model_name, model_dir):
-    if model_name not in models:
-        model_path = os.path.join(model_dir, model_name)
-        models[model_name] = VitsModel.from_pretrained(model_path).to(device)
-        tokenizers[model_name] = VitsTokenizer.from_pretrained(model_path)
-    return models[model_name], tokenizers[model_name]
-
-def generate_speech(text, model_dir, model_name, speaking_rate=1.0):
-    model, tokenizer = load_vits_model(model_name, model_dir)
-    processed_string = (text)
-    inputs = tokenizer(processed_string, return_tensors="pt")
+    # The registry's mtime for the model versions the cache entry, so updated weights are reloaded
+    # in every process, including dubbing workers
+    version = check_model(model_name, model_dir)['mtime']
+    return model_cache.get(model_name, lambda: read_vits_model(model_name, model_dir), version)
+
+def hold_vits_model(model_name, model_dir):
+    # Keeps the model out of eviction for the duration of a request
+    version = check_model(model_name, model_dir)['mtime']
+    return model_cache.hold(model_name, lambda: read_vits_model(model_name, model_dir), version)
+
+def generate_speech(text, model_dir, model_name, speaking_rate=1.0, noise_scale=None, noise_scale_duration=None, seed=None):
+    # With a seed the output is reproducible, so it is served from the waveform cache when possible
+    if seed is not None:
+        digest = waveform_key(os.path.join(model_dir, model_name), text, speaking_rate, noise_scale, noise_scale_duration, seed)
+        cached = load_waveform(digest)
+        if cached is not None:
+            return cached
+
+    with hold_vits_model(model_name, model_dir) as (model, tokenizer):
+        processed_string = (text)
+        inputs = tokenize(tokenizer, processed_string)
     
-    # Move inputs to device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+        # Move inputs to device
+        inputs = {k: v.to(device) for k, v in inputs.items()}
     
-    #set_seed(456)
+        #set_seed(456)
     
-    # Set model parameters
-    model.speaking_rate = speaking_rate
-    model.sentence_silence = 0
-    #model.energy = 10
-    with torch.no_grad():
-        outputs = model(**inputs)
+        # Set model parameters
+        with model_lock(model_name), torch.no_grad(), rng_lock.hold(seed):
+            model.speaking_rate = speaking_rate
+            model.sentence_silence = 0
+            set_noise(model, noise_scale, noise_scale_duration)
+            #model.energy = 10
+            outputs = model(**inputs)
     
-    # Move output back to CPU for audio processing
-    waveform = outputs.waveform[0].cpu().numpy()
+        # Move output back to CPU for audio processing
+        waveform = outputs.waveform[0].cpu().numpy()
     
-    #resampled_audio = resample_poly(waveform, 16000, 16000)  # Assuming the original sampling rate is 22050
-    sampling_rate = model.config.sampling_rate
-
-    # Ensure correct sampling rate
-    #if hasattr(model.config, 'sampling_rate'):
-    #    sampling_rate = model.config.sampling_rate
-    #else:
-    #    sampling_rate = 48000
+        #resampled_audio = resample_poly(waveform, 16000, 16000)  # Assuming the original sampling rate is 22050
+        sampling_rate = model.config.sampling_rate
+
+        # Ensure correct sampling rate
+        #if hasattr(model.config, 'sampling_rate'):
+        #    sampling_rate = model.config.sampling_rate
+        #else:
+        #    sampling_rate = 48000
     
-    return sampling_rate, waveform
+        if seed is not None:
+            save_waveform(digest, sampling_rate, waveform)
+        return sampling_rate, waveform
+
+def generate_speech_batch(texts, model_dir, model_name, speaking_rate=1.0, batch_size=16, noise_scale=None, noise_scale_duration=None):
+    with hold_vits_model(model_name, model_dir) as (model, tokenizer):
+        input_ids = [list(token_ids(tokenizer, text)) for text in texts]
+
+        # Sort by token length so each batch pads as little as possible
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+
+        waveforms = [None] * len(texts)
+        for batch_start in range(0, len(order), batch_size):
+            batch_indices = order[batch_start:batch_start + batch_size]
+            inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch_indices]}, return_tensors="pt")
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+
+            with model_lock(model_name), torch.no_grad(), rng_lock.shared():
+                model.speaking_rate = speaking_rate
+                model.sentence_silence = 0
+                set_noise(model, noise_scale, noise_scale_duration)
+                outputs = model(**inputs)
+
+            # Cut each padded waveform back to its true length
+            batch_waveforms = outputs.waveform.cpu().numpy()
+            sequence_lengths = outputs.sequence_lengths.cpu().numpy()
+            for row, i in enumerate(batch_indices):
+                waveforms[i] = batch_waveforms[row, :sequence_lengths[row]]
+
+        sampling_rate = model.config.sampling_rate
+        return sampling_rate, waveforms
+
+def generate_speech_cached(texts, model_dir, model_name, speaking_rate=1.0, noise_scale=None, noise_scale_duration=None):
+    # Lines rendered before with the same settings come from the render cache; only the rest are batched
+    fingerprint = model_fingerprint(os.path.join(model_dir, model_name))
+    keys = [line_key(fingerprint, text, speaking_rate, noise_scale, noise_scale_duration) for text in texts]
+    entries = lookup_lines(keys)
+    missing = missing_lines(entries)
+    if missing:
+        sampling_rate, waveforms = generate_speech_batch([texts[i] for i in missing], model_dir, model_name, speaking_rate,
+                                                         noise_scale=noise_scale, noise_scale_duration=noise_scale_duration)
+        store_lines([keys[i] for i in missing], sampling_rate, waveforms)
+        for i, waveform in zip(missing, waveforms):
+            entries[i] = (sampling_rate, waveform)
+    # Every line of one model shares its sampling rate
+    return entries[0][0], [waveform for _, waveform in entries], len(missing)
+
+def predict_durations(model, inputs):
+    # First half of VitsModel.forward: text encoder and duration predictor only, no flow or vocoder.
+    # Returns the unscaled frames per token; the output length at a speaking rate r is
+    # sum(ceil(durations / r)) * prod(upsample_rates)
+    attention_mask = inputs["attention_mask"]
+    input_padding_mask = attention_mask.unsqueeze(-1).to(model.text_encoder.embed_tokens.weight.dtype)
+    text_encoder_output = model.text_encoder(
+        input_ids=inputs["input_ids"],
+        padding_mask=input_padding_mask,
+        attention_mask=attention_mask,
+        return_dict=True,
+    )
+    hidden_states = text_encoder_output.last_hidden_state.transpose(1, 2)
+    input_padding_mask = input_padding_mask.transpose(1, 2)
+    if model.config.use_stochastic_duration_prediction:
+        log_duration = model.duration_predictor(hidden_states, input_padding_mask, None, reverse=True, noise_scale=model.noise_scale_duration)
+    else:
+        log_duration = model.duration_predictor(hidden_states, input_padding_mask, None)
+    return (torch.exp(log_duration) * input_padding_mask)[0, 0].cpu().numpy()
+
+def predicted_num_samples(durations, hop_length, speaking_rate):
+    frames = np.ceil(durations * np.float32(1.0 / speaking_rate)).sum()
+    return int(max(frames, 1)) * hop_length
+
+def fit_speaking_rate(durations, hop_length, max_samples, speaking_rate=1.0, max_rate=4.0):
+    if predicted_num_samples(durations, hop_length, speaking_rate) <= max_samples:
+        return speaking_rate
+    # The predicted length only shrinks as the rate grows, so bisect for the slowest rate that fits
+    low, high = speaking_rate, speaking_rate * max_rate
+    for _ in range(30):
+        mid = (low + high) / 2
+        if predicted_num_samples(durations, hop_length, mid) <= max_samples:
+            high = mid
+        else:
+            low = mid
+    return high
+
+def generate_speech_fit(text, model_dir, model_name, max_seconds, speaking_rate=1.0, seed=0):
+    with hold_vits_model(model_name, model_dir) as (model, tokenizer):
+        inputs = tokenize(tokenizer, text)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        sampling_rate = model.config.sampling_rate
+        hop_length = int(np.prod(model.config.upsample_rates))
+
+        # The same seed makes the full forward pass draw the same duration noise as the prediction,
+        # so the chosen rate fits exactly and the line is synthesized only once. Both passes hold the RNG
+        # exclusively so no other thread draws in between, and the generator state is restored afterwards
+        with model_lock(model_name), torch.no_grad(), rng_lock.seeded(seed):
+            set_noise(model)
+            durations = predict_durations(model, inputs)
+            fitted_rate = fit_speaking_rate(durations, hop_length, int(max_seconds * sampling_rate), speaking_rate)
+
+            model.speaking_rate = fitted_rate
+            model.sentence_silence = 0
+            torch.manual_seed(seed)
+            outputs = model(**inputs)
+
+        waveform = outputs.waveform[0].cpu().numpy()
+        return sampling_rate, waveform, fitted_rate
+
+def generate_speech_stream(text, model_dir, model_name, speaking_rate=1.0, crossfade_ms=20, timings=None):
+    start_time = time.perf_counter()
+    previous_tail = None
+
+    for chunk in split_thai_sentences(text):
+        sampling_rate, waveform = generate_speech(chunk, model_dir, model_name, speaking_rate)
+
+        # Blend the held-back tail of the previous chunk into the head of this one
+        if previous_tail is not None:
+            fade_len = min(len(previous_tail), len(waveform))
+            fade_in = np.linspace(0.0, 1.0, fade_len, dtype=waveform.dtype)
+            waveform = waveform.copy()
+            waveform[:fade_len] = waveform[:fade_len] * fade_in + previous_tail[:fade_len] * (1.0 - fade_in)
+
+        fade_len = min(int(sampling_rate * crossfade_ms / 1000), len(waveform) // 2)
+        previous_tail = waveform[len(waveform) - fade_len:]
+        body = waveform[:len(waveform) - fade_len]
+
+        if timings is not None and 'time_to_first_audio' not in timings:
+            timings['time_to_first_audio'] = time.perf_counter() - start_time
+        yield sampling_rate, body
+
+    if previous_tail is not None and len(previous_tail):
+        yield sampling_rate, previous_tail
+
+    if timings is not None:
+        timings['total'] = time.perf_counter() - start_time
 
 def save_audio(sampling_rate, audio_data, filename="output_tts.wav"):
     scipy.io.wavfile.write(filename, rate=sampling_rate, data=audio_data)
     return filename
 
-def voice_cloning(base_speaker, reference_speaker, model_version, device_choice, vad_select):
+def voice_cloning(base_speaker, reference_speaker, model_version, device_choice, vad_select, workspace=None):
     try:
-        ckpt_converter = f'./OPENVOICE_MODELS/{model_version}'
-        device = "cuda:0" if device_choice == "GPU" and torch.cuda.is_available() else "cpu"
-        
-        tone_color_converter = ToneColorConverter(f'{ckpt_converter}/config.json', device=device)
-        tone_color_converter.load_ckpt(f'{ckpt_converter}/checkpoint.pth')
+        workspace = ensure_workspace(workspace, 'tts')
+        tone_color_converter = get_tone_color_converter(model_version, device_choice)
 
         source_se, _ = se_extractor.get_se(base_speaker, tone_color_converter, vad=vad_select)
         target_se, _ = se_extractor.get_se(reference_speaker, tone_color_converter, vad=vad_select)
         
-        save_path = f'{output_dir}/output_cloned_tts.wav'
+        save_path = workspace.file('output_cloned_tts.wav')
         
         tone_color_converter.convert(
             audio_src_path=base_speaker, 
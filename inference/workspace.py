@@ -0,0 +1,57 @@
+import os
+import time
+import shutil
+import tempfile
+import soundfile
+
+# Every request writes into its own directory under workspace_root, so concurrent
+# queue workers never share file names
+workspace_root = './outputs/jobs'
+stale_seconds = 6 * 3600
+
+class JobWorkspace:
+    # cleanup: "always" removes the directory when the job ends (results returned in memory),
+    # "on_error" only when the job fails, "keep" leaves it for cleanup_stale_workspaces
+    def __init__(self, prefix='job', cleanup='always'):
+        os.makedirs(workspace_root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f'{prefix}_', dir=workspace_root)
+        self.cleanup = cleanup
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def close(self, failed=False):
+        if self.cleanup == 'always' or (self.cleanup == 'on_error' and failed):
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(failed=exc_type is not None)
+        return False
+
+def read_result(filename):
+    # Load an output file into memory as (sampling_rate, audio) before its workspace is removed
+    audio, sampling_rate = soundfile.read(filename, dtype='float32')
+    return sampling_rate, audio
+
+def cleanup_stale_workspaces(max_age=None):
+    max_age = stale_seconds if max_age is None else max_age
+    if not os.path.isdir(workspace_root):
+        return
+    now = time.time()
+    for name in os.listdir(workspace_root):
+        path = os.path.join(workspace_root, name)
+        try:
+            if os.path.isdir(path) and now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+def ensure_workspace(workspace, prefix):
+    # Callers that do not manage a workspace get a fresh one that is kept for the caller
+    if workspace is not None:
+        return workspace
+    cleanup_stale_workspaces()
+    return JobWorkspace(prefix, cleanup='keep')
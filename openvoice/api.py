@@ -7,7 +7,7 @@ from openvoice import commons
 import os
 import librosa
 from openvoice.text import text_to_sequence
-from openvoice.mel_processing import spectrogram_torch
+from openvoice.mel_processing import spectrogram_torch, spectrogram_torch_batch
 from openvoice.models import SynthesizerTrn
 
 
@@ -99,10 +99,10 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
 
 
 class ToneColorConverter(OpenVoiceBaseClass):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, enable_watermark=True, **kwargs):
         super().__init__(*args, **kwargs)
 
-        if kwargs.get('enable_watermark', True):
+        if enable_watermark:
             import wavmark
             self.watermark_model = wavmark.load_model().to(self.device)
         else:
@@ -111,26 +111,34 @@ class ToneColorConverter(OpenVoiceBaseClass):
 
 
 
-    def extract_se(self, ref_wav_list, se_save_path=None):
-        if isinstance(ref_wav_list, str):
+    def extract_se(self, ref_wav_list, se_save_path=None, batch_size=32):
+        if isinstance(ref_wav_list, (str, np.ndarray)):
             ref_wav_list = [ref_wav_list]
         
         device = self.device
         hps = self.hps
-        gs = []
+        waveforms = []
         
         for fname in ref_wav_list:
-            audio_ref, sr = librosa.load(fname, sr=hps.data.sampling_rate)
-            y = torch.FloatTensor(audio_ref)
-            y = y.to(device)
-            y = y.unsqueeze(0)
-            y = spectrogram_torch(y, hps.data.filter_length,
-                                        hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
-                                        center=False).to(device)
+            # Segments may be file paths or waveforms already at the model sampling rate
+            if isinstance(fname, str):
+                audio_ref, sr = librosa.load(fname, sr=hps.data.sampling_rate)
+            else:
+                audio_ref = fname
+            waveforms.append(torch.FloatTensor(audio_ref))
+
+        # Run the reference encoder over padded batches with a frame mask; the result
+        # matches encoding each segment on its own and averaging
+        gs = []
+        for i in range(0, len(waveforms), batch_size):
+            ys = [y.to(device) for y in waveforms[i:i + batch_size]]
+            spec, spec_lengths = spectrogram_torch_batch(ys, hps.data.filter_length,
+                                        hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length)
+            mask = commons.sequence_mask(spec_lengths, spec.size(-1))
             with torch.no_grad():
-                g = self.model.ref_enc(y.transpose(1, 2)).unsqueeze(-1)
+                g = self.model.ref_enc(spec.transpose(1, 2), mask=mask)
                 gs.append(g.detach())
-        gs = torch.stack(gs).mean(0)
+        gs = torch.cat(gs).mean(0, keepdim=True).unsqueeze(-1)
 
         if se_save_path is not None:
             os.makedirs(os.path.dirname(se_save_path), exist_ok=True)
@@ -138,12 +146,36 @@ class ToneColorConverter(OpenVoiceBaseClass):
 
         return gs
 
-    def convert(self, audio_src_path, src_se, tgt_se, output_path=None, tau=0.3, message="default"):
+    def convert(self, audio_src_path, src_se, tgt_se, output_path=None, tau=0.3, message="default",
+                window_seconds=None, overlap_seconds=0.5, watermark=True):
         hps = self.hps
+        if window_seconds is not None:
+            # Chunked mode: peak memory is bounded by the window, not the input length
+            pieces = self.convert_stream(audio_src_path, src_se, tgt_se, tau=tau, message=message,
+                                         window_seconds=window_seconds, overlap_seconds=overlap_seconds,
+                                         watermark=watermark)
+            if output_path is None:
+                return np.concatenate(list(pieces))
+            with soundfile.SoundFile(output_path, 'w', samplerate=hps.data.sampling_rate, channels=1) as f:
+                for piece in pieces:
+                    f.write(piece)
+            return
+
         # load audio
-        audio, sample_rate = librosa.load(audio_src_path, sr=hps.data.sampling_rate)
-        audio = torch.tensor(audio).float()
-        
+        if isinstance(audio_src_path, np.ndarray):
+            audio = audio_src_path
+        else:
+            audio, sample_rate = librosa.load(audio_src_path, sr=hps.data.sampling_rate)
+        audio = self.convert_array(audio, src_se, tgt_se, tau=tau)
+        if watermark:
+            audio = self.add_watermark(audio, message)
+        if output_path is None:
+            return audio
+        else:
+            soundfile.write(output_path, audio, hps.data.sampling_rate)
+
+    def convert_array(self, audio, src_se, tgt_se, tau=0.3):
+        hps = self.hps
         with torch.no_grad():
             y = torch.FloatTensor(audio).to(self.device)
             y = y.unsqueeze(0)
@@ -153,12 +185,93 @@ class ToneColorConverter(OpenVoiceBaseClass):
             spec_lengths = torch.LongTensor([spec.size(-1)]).to(self.device)
             audio = self.model.voice_conversion(spec, spec_lengths, sid_src=src_se, sid_tgt=tgt_se, tau=tau)[0][
                         0, 0].data.cpu().float().numpy()
-            audio = self.add_watermark(audio, message)
-            if output_path is None:
-                return audio
-            else:
-                soundfile.write(output_path, audio, hps.data.sampling_rate)
-    
+        return audio
+
+    def convert_stream(self, audio_src_path, src_se, tgt_se, tau=0.3, message="default",
+                       window_seconds=30.0, overlap_seconds=0.5, watermark=True):
+        sr = self.hps.data.sampling_rate
+        window = int(window_seconds * sr)
+        overlap = min(int(overlap_seconds * sr), window // 2)
+        pieces = self.convert_windows(self.iter_audio_windows(audio_src_path, window, overlap),
+                                      src_se, tgt_se, tau, overlap)
+        if not watermark:
+            return pieces
+        return self.watermark_stream(pieces, message)
+
+    def convert_windows(self, windows, src_se, tgt_se, tau, overlap):
+        previous_tail = None
+        for chunk in windows:
+            converted = self.convert_array(chunk, src_se, tgt_se, tau=tau)
+            # The decoder output is a few samples short of the input; pad to keep windows aligned
+            converted = np.pad(converted, (0, max(0, len(chunk) - len(converted))))[:len(chunk)]
+
+            if previous_tail is not None:
+                fade_len = min(len(previous_tail), len(converted))
+                fade_in = np.linspace(0.0, 1.0, fade_len, dtype=np.float32)
+                converted[:fade_len] = converted[:fade_len] * fade_in + previous_tail[:fade_len] * (1.0 - fade_in)
+
+            tail_len = min(overlap, len(converted))
+            previous_tail = converted[len(converted) - tail_len:]
+            yield converted[:len(converted) - tail_len]
+
+        if previous_tail is not None and len(previous_tail):
+            yield previous_tail
+
+    def iter_audio_windows(self, audio_src_path, window, overlap):
+        sr = self.hps.data.sampling_rate
+        hop = window - overlap
+
+        if isinstance(audio_src_path, np.ndarray):
+            audio = audio_src_path
+            for start in range(0, max(len(audio) - overlap, 1), hop):
+                yield audio[start:start + window]
+            return
+
+        try:
+            f = soundfile.SoundFile(audio_src_path)
+        except RuntimeError:
+            # Formats soundfile cannot read are decoded in full
+            yield from self.iter_audio_windows(librosa.load(audio_src_path, sr=sr)[0], window, overlap)
+            return
+
+        with f:
+            src_sr = f.samplerate
+            total = int(f.frames * sr / src_sr)
+            for start in range(0, max(total - overlap, 1), hop):
+                # Seek from the absolute position so resampling rounding does not drift
+                length = min(window, total - start)
+                f.seek(int(round(start * src_sr / sr)))
+                chunk = f.read(int(round(length * src_sr / sr)) + 1, dtype='float32', always_2d=True).mean(axis=1)
+                if src_sr != sr:
+                    chunk = librosa.resample(chunk, orig_sr=src_sr, target_sr=sr)
+                yield np.pad(chunk, (0, max(0, length - len(chunk))))[:length]
+
+    def watermark_stream(self, pieces, message):
+        if self.watermark_model is None:
+            yield from pieces
+            return
+
+        # Hold back output until the watermarked prefix is complete
+        span = self.watermark_span(message)
+        buffered = []
+        buffered_len = 0
+        for piece in pieces:
+            if buffered is None:
+                yield piece
+                continue
+            buffered.append(piece)
+            buffered_len += len(piece)
+            if buffered_len >= span:
+                yield self.add_watermark(np.concatenate(buffered), message)
+                buffered = None
+        if buffered:
+            yield self.add_watermark(np.concatenate(buffered), message)
+
+    def watermark_span(self, message, K=16000, coeff=2):
+        # Samples at the converter rate from the start of the audio to the end of the last chunk carrying the message
+        n_repeat = len(utils.string_to_bits(message).reshape(-1)) // 32
+        return (coeff * (n_repeat - 1) + 1) * K
+
     def add_watermark(self, audio, message):
         if self.watermark_model is None:
             return audio
@@ -168,35 +281,40 @@ class ToneColorConverter(OpenVoiceBaseClass):
 
         K = 16000
         coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to add watermark')
-                break
-            message_npy = bits[n * 32: (n + 1) * 32]
-            
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(device)[None]
-                message_tensor = torch.FloatTensor(message_npy).to(device)[None]
-                signal_wmd_tensor = self.watermark_model.encode(signal, message_tensor)
-                signal_wmd_npy = signal_wmd_tensor.detach().cpu().squeeze()
-            audio[(coeff * n) * K: (coeff * n + 1) * K] = signal_wmd_npy
+        starts = self.watermark_chunk_starts(len(audio), n_repeat, K, coeff)
+        if len(starts) < n_repeat:
+            print('Audio too short, fail to add watermark')
+        if len(starts) == 0:
+            return audio
+
+        # Encode every chunk in one batch and scatter the results back
+        with torch.no_grad():
+            signal = torch.FloatTensor(np.stack([audio[s: s + K] for s in starts])).to(device)
+            message_tensor = torch.FloatTensor(bits[:len(starts) * 32].reshape(len(starts), 32)).to(device)
+            signal_wmd_npy = self.watermark_model.encode(signal, message_tensor).detach().cpu().numpy()
+        for s, signal_wmd in zip(starts, signal_wmd_npy):
+            audio[s: s + K] = signal_wmd
         return audio
 
     def detect_watermark(self, audio, n_repeat):
-        bits = []
         K = 16000
         coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to detect watermark')
-                return 'Fail'
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(self.device).unsqueeze(0)
-                message_decoded_npy = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy().squeeze()
-            bits.append(message_decoded_npy)
-        bits = np.stack(bits).reshape(-1, 8)
+        starts = self.watermark_chunk_starts(len(audio), n_repeat, K, coeff)
+        if len(starts) < n_repeat:
+            print('Audio too short, fail to detect watermark')
+            return 'Fail'
+        with torch.no_grad():
+            signal = torch.FloatTensor(np.stack([audio[s: s + K] for s in starts])).to(self.device)
+            bits = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy()
+        bits = bits.reshape(-1, 8)
         message = utils.bits_to_string(bits)
         return message
+
+    @staticmethod
+    def watermark_chunk_starts(audio_len, n_repeat, K=16000, coeff=2):
+        # Start offsets of the whole K-sample chunks that carry the message
+        if audio_len < K:
+            return []
+        n_chunks = min(n_repeat, (audio_len - K) // (coeff * K) + 1)
+        return [coeff * n * K for n in range(n_chunks)]
     
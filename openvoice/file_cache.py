@@ -0,0 +1,89 @@
+import os
+import time
+import tempfile
+import threading
+
+# Helpers shared by the on-disk caches (speaker embeddings, seeded waveforms): atomic writes and
+# least-recently-used eviction by file mtime. Each directory's size is tracked as files are added,
+# so a write only rescans the directory when a budget is exceeded or the last scan is old
+rescan_interval = 3600
+low_water = 0.9
+
+cache_usage = {}
+cache_usage_lock = threading.Lock()
+
+def write_atomic(path, write):
+    # Write to a temporary file first so readers never see a partial entry
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def touch(path):
+    # Refresh the mtime so eviction keeps frequently used entries
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def evict_files(cache_dir, suffix, max_files=None, max_bytes=None, max_age=None):
+    # Keeps the most recently used files within the limits; returns (files, bytes) kept
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for fname in files:
+            if not fname.endswith(suffix):
+                continue
+            path = os.path.join(root, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort(reverse=True)
+
+    now = time.time()
+    num_files = total = 0
+    full = False
+    for mtime, size, path in entries:
+        # Everything older than the first file over a limit goes too
+        full = full or (max_files is not None and num_files >= max_files) or (max_bytes is not None and total + size > max_bytes)
+        if full or (max_age is not None and now - mtime > max_age):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        num_files += 1
+        total += size
+
+    with cache_usage_lock:
+        cache_usage[os.path.normpath(cache_dir)] = {'files': num_files, 'bytes': total, 'scanned': now}
+    return num_files, total
+
+def store_file(path, write, cache_dir, suffix, max_files=None, max_bytes=None, max_age=None):
+    replaced = os.path.getsize(path) if os.path.exists(path) else 0
+    write_atomic(path, write)
+    size = os.path.getsize(path)
+
+    key = os.path.normpath(cache_dir)
+    with cache_usage_lock:
+        usage = cache_usage.get(key)
+        if usage is not None:
+            usage['files'] += 0 if replaced else 1
+            usage['bytes'] += size - replaced
+        rescan = (usage is None or time.time() - usage['scanned'] > rescan_interval
+                  or (max_files is not None and usage['files'] > max_files)
+                  or (max_bytes is not None and usage['bytes'] > max_bytes))
+    if rescan:
+        # Trim below the budget so the next writes do not trigger another scan right away
+        evict_files(cache_dir, suffix,
+                    max_files=None if max_files is None else int(max_files * low_water),
+                    max_bytes=None if max_bytes is None else int(max_bytes * low_water),
+                    max_age=max_age)
@@ -75,6 +75,43 @@ def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False)
     return spec
 
 
+def spectrogram_torch_batch(ys, n_fft, sampling_rate, hop_size, win_size):
+    # Batched spectrogram_torch for waveforms of different lengths. Each waveform is
+    # reflect-padded on its own before zero-padding to a common length, so the valid
+    # frames of every item match spectrogram_torch exactly.
+    global hann_window
+    dtype_device = str(ys[0].dtype) + "_" + str(ys[0].device)
+    wnsize_dtype_device = str(win_size) + "_" + dtype_device
+    if wnsize_dtype_device not in hann_window:
+        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(
+            dtype=ys[0].dtype, device=ys[0].device
+        )
+
+    pad = int((n_fft - hop_size) / 2)
+    padded = [
+        torch.nn.functional.pad(y.view(1, 1, -1), (pad, pad), mode="reflect").view(-1)
+        for y in ys
+    ]
+    spec_lengths = torch.LongTensor([(y.size(0) - n_fft) // hop_size + 1 for y in padded])
+    y = torch.nn.utils.rnn.pad_sequence(padded, batch_first=True)
+
+    spec = torch.stft(
+        y,
+        n_fft,
+        hop_length=hop_size,
+        win_length=win_size,
+        window=hann_window[wnsize_dtype_device],
+        center=False,
+        pad_mode="reflect",
+        normalized=False,
+        onesided=True,
+        return_complex=False,
+    )
+
+    spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+    return spec, spec_lengths.to(spec.device)
+
+
 def spectrogram_torch_conv(y, n_fft, sampling_rate, hop_size, win_size, center=False):
     # if torch.min(y) < -1.:
     #     print('min value is ', torch.min(y))
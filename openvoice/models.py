@@ -343,10 +343,21 @@ class ReferenceEncoder(nn.Module):
         if self.layernorm is not None:
             out = self.layernorm(out)
 
+        # mask --- [N, Ty], 1 for valid frames; padded frames are zeroed after every
+        # layer so each item sees exactly what it would see unbatched
+        lengths = None
+        if mask is not None:
+            lengths = mask.sum(-1).long()
+            out = out * mask.view(N, 1, -1, 1).to(out.dtype)
+
         for conv in self.convs:
             out = conv(out)
             # out = wn(out)
             out = F.relu(out)  # [N, 128, Ty//2^K, n_mels//2^K]
+            if lengths is not None:
+                lengths = (lengths - 1) // 2 + 1
+                frame_mask = commons.sequence_mask(lengths, out.size(2))
+                out = out * frame_mask.view(N, 1, -1, 1).to(out.dtype)
 
         out = out.transpose(1, 2)  # [N, Ty//2^K, 128, n_mels//2^K]
         T = out.size(1)
@@ -354,6 +365,8 @@ class ReferenceEncoder(nn.Module):
         out = out.contiguous().view(N, T, -1)  # [N, Ty//2^K, 128*n_mels//2^K]
 
         self.gru.flatten_parameters()
+        if lengths is not None:
+            out = nn.utils.rnn.pack_padded_sequence(out, lengths.cpu(), batch_first=True, enforce_sorted=False)
         memory, out = self.gru(out)  # out --- [1, N, 128]
 
         return self.proj(out.squeeze(0))
@@ -1,40 +1,43 @@
 import os
-import glob
+import threading
 import torch
 import hashlib
 import librosa
 import base64
-from glob import glob
 import numpy as np
-from pydub import AudioSegment
 from faster_whisper import WhisperModel
 import hashlib
 import base64
 import librosa
-from whisper_timestamped.transcribe import get_audio_tensor, get_vad_segments
+from collections import OrderedDict
+from openvoice.file_cache import store_file, evict_files, touch
+from whisper_timestamped.transcribe import get_vad_segments
 
+# Whisper transcriber settings; device and compute type default to CUDA/float16
+# when a GPU is available and CPU/int8 otherwise
 model_size = "medium"
-# Run on GPU with FP16
-model = None
-def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
-    global model
-    if model is None:
-        model = WhisperModel(model_size, device="cuda", compute_type="float16")
-    audio = AudioSegment.from_file(audio_path)
-    max_len = len(audio)
-
-    target_folder = os.path.join(target_dir, audio_name)
-    
-    segments, info = model.transcribe(audio_path, beam_size=2, word_timestamps=True)
-    segments = list(segments)    
-
-    # create directory
-    os.makedirs(target_folder, exist_ok=True)
-    wavs_folder = os.path.join(target_folder, 'wavs')
-    os.makedirs(wavs_folder, exist_ok=True)
-
-    # segments
-    s_ind = 0
+whisper_device = None
+whisper_compute_type = None
+whisper_models = {}
+whisper_lock = threading.Lock()
+
+def get_whisper_model(size=None, device=None, compute_type=None):
+    size = size or model_size
+    device = device or whisper_device or ("cuda" if torch.cuda.is_available() else "cpu")
+    compute_type = compute_type or whisper_compute_type or ("float16" if device == "cuda" else "int8")
+    key = (size, device, compute_type)
+    with whisper_lock:
+        if key not in whisper_models:
+            whisper_models[key] = WhisperModel(size, device=device, compute_type=compute_type)
+        return whisper_models[key]
+
+def split_audio_whisper_segments(audio, sr, size=None):
+    # Returns the usable transcribed segments as in-memory views with their text and confidence
+    model = get_whisper_model(size)
+    segments, info = model.transcribe(librosa.resample(audio, orig_sr=sr, target_sr=16000), beam_size=2, word_timestamps=True)
+    segments = list(segments)
+
+    results = []
     start_time = None
     
     for k, w in enumerate(segments):
@@ -53,30 +56,22 @@ def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
         text = w.text.replace('...', '')
 
         # left 0.08s for each audios
-        audio_seg = audio[int( start_time * 1000) : min(max_len, int(end_time * 1000) + 80)]
-
-        # segment file name
-        fname = f"{audio_name}_seg{s_ind}.wav"
+        audio_seg = audio[int(start_time * sr): min(len(audio), int((end_time + 0.08) * sr))]
+        duration = len(audio_seg) / sr
 
         # filter out the segment shorter than 1.5s and longer than 20s
-        save = audio_seg.duration_seconds > 1.5 and \
-                audio_seg.duration_seconds < 20. and \
-                len(text) >= 2 and len(text) < 200 
-
-        if save:
-            output_file = os.path.join(wavs_folder, fname)
-            audio_seg.export(output_file, format='wav')
+        if duration > 1.5 and duration < 20. and len(text) >= 2 and len(text) < 200:
+            results.append({'index': k, 'audio': audio_seg, 'text': text, 'confidence': confidence})
 
         if k < len(segments) - 1:
             start_time = max(0, segments[k+1].start - 0.08)
 
-        s_ind = s_ind + 1
-    return wavs_folder
-
+    return results
 
-def split_audio_vad(audio_path, audio_name, target_dir, split_seconds=1.0):
+def split_audio_vad_segments(audio, sr, split_seconds=1.0):
+    # Returns views into the VAD-active audio, split into roughly split_seconds pieces
     SAMPLE_RATE = 16000
-    audio_vad = get_audio_tensor(audio_path)
+    audio_vad = torch.from_numpy(librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE))
     segments = get_vad_segments(
         audio_vad,
         output_sample=True,
@@ -84,70 +79,112 @@ def split_audio_vad(audio_path, audio_name, target_dir, split_seconds=1.0):
         min_silence_duration=1,
         method="silero",
     )
-    segments = [(seg["start"], seg["end"]) for seg in segments]
-    segments = [(float(s) / SAMPLE_RATE, float(e) / SAMPLE_RATE) for s,e in segments]
+    segments = [(float(seg["start"]) / SAMPLE_RATE, float(seg["end"]) / SAMPLE_RATE) for seg in segments]
     print(segments)
-    audio_active = AudioSegment.silent(duration=0)
-    audio = AudioSegment.from_file(audio_path)
+    if len(segments) == 0:
+        return []
 
-    for start_time, end_time in segments:
-        audio_active += audio[int( start_time * 1000) : int(end_time * 1000)]
-    
-    audio_dur = audio_active.duration_seconds
+    audio_active = np.concatenate([audio[int(start_time * sr): int(end_time * sr)] for start_time, end_time in segments])
+    audio_dur = len(audio_active) / sr
     print(f'after vad: dur = {audio_dur}')
-    target_folder = os.path.join(target_dir, audio_name)
-    wavs_folder = os.path.join(target_folder, 'wavs')
-    os.makedirs(wavs_folder, exist_ok=True)
-    start_time = 0.
-    count = 0
+
     num_splits = int(np.round(audio_dur / split_seconds))
     assert num_splits > 0, 'input audio is too short'
-    interval = audio_dur / num_splits
-
-    for i in range(num_splits):
-        end_time = min(start_time + interval, audio_dur)
-        if i == num_splits - 1:
-            end_time = audio_dur
-        output_file = f"{wavs_folder}/{audio_name}_seg{count}.wav"
-        audio_seg = audio_active[int(start_time * 1000): int(end_time * 1000)]
-        audio_seg.export(output_file, format='wav')
-        start_time = end_time
-        count += 1
-    return wavs_folder
-
-def hash_numpy_array(audio_path):
-    array, _ = librosa.load(audio_path, sr=None, mono=True)
-    # Convert the array to bytes
-    array_bytes = array.tobytes()
-    # Calculate the hash of the array bytes
-    hash_object = hashlib.sha256(array_bytes)
-    hash_value = hash_object.digest()
+    bounds = np.linspace(0, len(audio_active), num_splits + 1).astype(int)
+    return [audio_active[bounds[i]: bounds[i + 1]] for i in range(num_splits)]
+
+def hash_numpy_array(audio_path, block_size=65536):
+    # Key on the file bytes so a cache hit never decodes the audio and a miss decodes it only once, in get_se
+    hash_value = hash_file_bytes(audio_path, block_size)
     # Convert the hash value to base64
     base64_value = base64.b64encode(hash_value)
     return base64_value.decode('utf-8')[:16].replace('/', '_^')
 
+def hash_file_bytes(audio_path, block_size):
+    hash_object = hashlib.sha256()
+    with open(audio_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hash_object.update(block)
+    return hash_object.digest()
+
+# Speaker-embedding cache: an in-memory LRU in front of content-addressed files on disk
+se_cache_memory_size = 64
+se_cache_max_files = 5000
+se_cache_max_age = 30 * 24 * 3600
+se_cache = OrderedDict()
+se_cache_lock = threading.Lock()
+se_cache_stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+def se_cache_path(cache_key, target_dir):
+    return os.path.join(target_dir, 'se_cache', f'{cache_key}.pth')
+
+def load_cached_se(cache_key, target_dir, device):
+    with se_cache_lock:
+        if cache_key in se_cache:
+            se_cache.move_to_end(cache_key)
+            se_cache_stats['memory_hits'] += 1
+            return se_cache[cache_key].to(device)
+
+    se_path = se_cache_path(cache_key, target_dir)
+    if not os.path.isfile(se_path):
+        with se_cache_lock:
+            se_cache_stats['misses'] += 1
+        return None
+
+    se = torch.load(se_path, map_location='cpu')
+    touch(se_path)
+    remember_se(cache_key, se)
+    with se_cache_lock:
+        se_cache_stats['disk_hits'] += 1
+    return se.to(device)
+
+def remember_se(cache_key, se):
+    with se_cache_lock:
+        se_cache[cache_key] = se
+        se_cache.move_to_end(cache_key)
+        while len(se_cache) > se_cache_memory_size:
+            se_cache.popitem(last=False)
+
+def save_cached_se(cache_key, se, target_dir):
+    se = se.detach().cpu()
+    remember_se(cache_key, se)
+
+    se_path = se_cache_path(cache_key, target_dir)
+    store_file(se_path, lambda f: torch.save(se, f), os.path.dirname(se_path), '.pth',
+               max_files=se_cache_max_files, max_age=se_cache_max_age)
+
+def evict_se_cache(target_dir, max_files=None, max_age=None):
+    max_files = se_cache_max_files if max_files is None else max_files
+    max_age = se_cache_max_age if max_age is None else max_age
+    cache_dir = os.path.join(target_dir, 'se_cache')
+    if os.path.isdir(cache_dir):
+        evict_files(cache_dir, '.pth', max_files=max_files, max_age=max_age)
+
 def get_se(audio_path, vc_model, target_dir='processed', vad=True):
     device = vc_model.device
     version = vc_model.version
     print("OpenVoice version:", version)
 
-    audio_name = f"{os.path.basename(audio_path).rsplit('.', 1)[0]}_{version}_{hash_numpy_array(audio_path)}"
-    se_path = os.path.join(target_dir, audio_name, 'se.pth')
+    audio_hash = hash_numpy_array(audio_path)
+    audio_name = f"{os.path.basename(audio_path).rsplit('.', 1)[0]}_{version}_{audio_hash}"
+    cache_key = f"{version}_{'vad' if vad else 'whisper'}_{audio_hash}"
+
+    se = load_cached_se(cache_key, target_dir, device)
+    if se is not None:
+        return se, audio_name
 
-    # if os.path.isfile(se_path):
-    #     se = torch.load(se_path).to(device)
-    #     return se, audio_name
-    # if os.path.isdir(audio_path):
-    #     wavs_folder = audio_path
+    # Decode once at the converter rate and share the waveform with the splitters
+    sr = vc_model.hps.data.sampling_rate
+    audio, _ = librosa.load(audio_path, sr=sr, mono=True)
     
     if vad:
-        wavs_folder = split_audio_vad(audio_path, target_dir=target_dir, audio_name=audio_name)
+        audio_segs = split_audio_vad_segments(audio, sr)
     else:
-        wavs_folder = split_audio_whisper(audio_path, target_dir=target_dir, audio_name=audio_name)
+        audio_segs = [seg['audio'] for seg in split_audio_whisper_segments(audio, sr)]
     
-    audio_segs = glob(f'{wavs_folder}/*.wav')
     if len(audio_segs) == 0:
         raise NotImplementedError('No audio segments found!')
     
-    return vc_model.extract_se(audio_segs, se_save_path=se_path), audio_name
-
+    se = vc_model.extract_se(audio_segs)
+    save_cached_se(cache_key, se, target_dir)
+    return se, audio_name